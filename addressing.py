@@ -0,0 +1,36 @@
+from telegram import MessageEntity
+from telegram.ext.filters import MessageFilter
+
+
+class AddressedToBot(MessageFilter):
+    """Passes messages that mention the bot or reply to one of its messages.
+
+    Looks only at the parsed entities and the replied-to sender, so the vast majority of
+    group messages, which carry no mention at all, are rejected without touching the text.
+    """
+
+    __slots__ = ('bot_id', 'mention')
+
+    def __init__(self):
+        super().__init__(name='AddressedToBot')
+        self.bot_id = None
+        self.mention = None
+
+    def set_bot(self, bot):
+        self.bot_id = bot.id
+        self.mention = f'@{bot.username}'.lower()
+
+    def filter(self, message):
+        if self.mention is None:
+            self.set_bot(message.get_bot())
+        reply = message.reply_to_message
+        if reply and reply.from_user and reply.from_user.id == self.bot_id:
+            return True
+        for entity in message.entities:
+            if entity.type == MessageEntity.MENTION:
+                # Usernames are ASCII, so the UTF-16 entity length equals the string length.
+                if entity.length == len(self.mention) and message.parse_entity(entity).lower() == self.mention:
+                    return True
+            elif entity.type == MessageEntity.TEXT_MENTION and entity.user and entity.user.id == self.bot_id:
+                return True
+        return False
@@ -0,0 +1,226 @@
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import Counter
+
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from telegram.request import BaseRequest
+
+BOT_ID = 777000
+BOT_USERNAME = 'mitgptbot'
+
+
+class FakeBotAPI(BaseRequest):
+    def __init__(self, latency=0.0, bot_id=BOT_ID, username=BOT_USERNAME, on_call=None):
+        self.latency = latency
+        self.bot_id = bot_id
+        self.username = username
+        self.on_call = on_call
+        self.calls = Counter()
+        self.sent = []
+        self.message_ids = itertools.count(1)
+        self.file_ids = itertools.count(1)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit('/', 1)[-1]
+        self.calls[api_method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        params = request_data.parameters if request_data else {}
+        if self.on_call:
+            self.on_call(api_method, params)
+        result = self.respond(api_method, params)
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+    def respond(self, api_method, params):
+        if api_method == 'getMe':
+            return {'id': self.bot_id, 'is_bot': True, 'first_name': 'Mitek', 'username': self.username}
+        if api_method in ('sendMessage', 'sendVoice'):
+            message = {
+                'message_id': next(self.message_ids),
+                'date': int(time.time()),
+                'chat': {'id': params.get('chat_id'), 'type': 'supergroup'},
+                'from': {'id': self.bot_id, 'is_bot': True, 'first_name': 'Mitek'},
+            }
+            if api_method == 'sendVoice':
+                file_id = f'voice-{next(self.file_ids)}'
+                message['voice'] = {'file_id': file_id, 'file_unique_id': file_id, 'duration': 1}
+            else:
+                message['text'] = params.get('text', '')
+            self.sent.append((time.perf_counter(), params.get('chat_id'), params.get('reply_to_message_id')))
+            return message
+        if api_method == 'getUpdates':
+            return []
+        return True
+
+
+def matches(doc, query):
+    for key, condition in query.items():
+        value = doc.get(key)
+        if isinstance(condition, dict):
+            for op, operand in condition.items():
+                if op == '$in' and value not in operand:
+                    return False
+                if op == '$lt' and not (value is not None and value < operand):
+                    return False
+                if op == '$gt' and not (value is not None and value > operand):
+                    return False
+                if op == '$ne' and value == operand:
+                    return False
+        elif value != condition:
+            return False
+    return True
+
+
+def project(doc, projection):
+    if not projection:
+        return dict(doc)
+    return {key: value for key, value in doc.items() if key == '_id' or projection.get(key)}
+
+
+class MemoryCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    async def to_list(self, length=None):
+        return self.docs if length is None else self.docs[:length]
+
+    def __aiter__(self):
+        return self.iterate()
+
+    async def iterate(self):
+        for doc in self.docs:
+            yield doc
+
+
+class MemoryResult:
+    def __init__(self, inserted_id=None, upserted_count=0):
+        self.inserted_id = inserted_id
+        self.upserted_count = upserted_count
+
+
+class MemoryCollection:
+    def __init__(self, name):
+        self.name = name
+        self.docs = {}
+
+    def find(self, query=None, projection=None, sort=None, limit=0):
+        docs = [project(doc, projection) for doc in self.docs.values() if matches(doc, query or {})]
+        for key, direction in reversed(sort or []):
+            docs.sort(key=lambda doc: doc.get(key), reverse=direction < 0)
+        return MemoryCursor(docs[:limit] if limit else docs)
+
+    async def find_one(self, query=None, projection=None, sort=None):
+        docs = await self.find(query, projection, sort, limit=1).to_list()
+        return docs[0] if docs else None
+
+    async def insert_one(self, doc):
+        doc.setdefault('_id', ObjectId())
+        self.docs[doc['_id']] = dict(doc)
+        return MemoryResult(inserted_id=doc['_id'])
+
+    async def insert_many(self, docs):
+        for doc in docs:
+            await self.insert_one(doc)
+
+    async def delete_one(self, query):
+        for doc_id, doc in self.docs.items():
+            if matches(doc, query):
+                del self.docs[doc_id]
+                return
+
+    async def find_one_and_delete(self, query, projection=None, sort=None):
+        doc = await self.find_one(query, projection, sort)
+        if doc:
+            del self.docs[doc['_id']]
+        return doc
+
+    def aggregate(self, pipeline):
+        docs = list(self.docs.values())
+        for stage in pipeline:
+            if '$sample' in stage:
+                docs = random.sample(docs, min(len(docs), stage['$sample']['size']))
+            elif '$project' in stage:
+                docs = [project(doc, stage['$project']) for doc in docs]
+        return MemoryCursor(docs)
+
+    async def delete_many(self, query):
+        for doc_id in [doc_id for doc_id, doc in self.docs.items() if matches(doc, query)]:
+            del self.docs[doc_id]
+
+    async def update_many(self, query, update):
+        for doc in self.docs.values():
+            if matches(doc, query):
+                doc.update(update.get('$set', {}))
+
+    async def update_one(self, query, update, upsert=False):
+        return MemoryResult(upserted_count=self.apply_update(query, update, upsert))
+
+    async def bulk_write(self, requests, ordered=True):
+        upserted = 0
+        for request in requests:
+            upserted += self.apply_update(request._filter, request._doc, request._upsert)
+        return MemoryResult(upserted_count=upserted)
+
+    def apply_update(self, query, update, upsert):
+        for doc in self.docs.values():
+            if matches(doc, query):
+                doc.update(update.get('$set', {}))
+                return 0
+        if not upsert:
+            return 0
+        doc = {key: value for key, value in query.items() if not isinstance(value, dict)}
+        doc.update(update.get('$set', {}))
+        doc.update(update.get('$setOnInsert', {}))
+        doc.setdefault('_id', ObjectId())
+        if doc['_id'] in self.docs:
+            raise DuplicateKeyError(f"E11000 duplicate key error, _id: {doc['_id']}")
+        self.docs[doc['_id']] = doc
+        return 1
+
+    async def create_index(self, keys, **kwargs):
+        return '_'.join(f'{key}_{direction}' for key, direction in keys)
+
+    async def estimated_document_count(self):
+        return len(self.docs)
+
+    async def count_documents(self, query):
+        return sum(1 for doc in self.docs.values() if matches(doc, query))
+
+
+class MemoryChangeStream:
+    async def __aenter__(self):
+        raise OperationFailure("The $changeStream stage is only supported on replica sets", code=40573)
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+
+class MemoryDatabase:
+    def __init__(self):
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = MemoryCollection(name)
+        return self.collections[name]
+
+    def watch(self, pipeline=None, **kwargs):
+        return MemoryChangeStream()
+
+    async def command(self, name, *args, **kwargs):
+        return {'ok': 1.0}
@@ -0,0 +1,241 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from collections import defaultdict, deque
+
+from telegram import Update
+
+from benchmarks.fakes import FakeBotAPI, MemoryDatabase
+from benchmarks.run import TOKEN, percentiles
+from update_recorder import read_recording
+
+# Calls that answer an update; anything else (typing, getMe, ...) is not a reply.
+REPLY_METHODS = {'sendMessage', 'sendVoice', 'sendAudio', 'editMessageText', 'answerCallbackQuery'}
+
+
+def load_recording(path, max_gap):
+    """The recorded bot identity and (offset in seconds, payload) pairs, with idle gaps cut to max_gap."""
+    identity = None
+    updates = []
+    offset = previous = None
+    for record in read_recording(path):
+        if 'bot' in record:
+            identity = identity or record['bot']
+            continue
+        offset = 0.0 if previous is None else offset + min(record['t'] - previous, max_gap)
+        previous = record['t']
+        updates.append((offset, record['u']))
+    return identity, updates
+
+
+def addressed_key(payload, identity):
+    """The key a reply to this update will be matched by, or None if the bot is not expected to answer."""
+    if 'callback_query' in payload:
+        return ('callback', str(payload['callback_query']['id']))
+    message = payload.get('message') or {}
+    text = message.get('text') or ''
+    reply_to = (message.get('reply_to_message') or {}).get('from') or {}
+    if text.startswith('/') or f"@{identity['username']}" in text or reply_to.get('id') == identity['id']:
+        return ('chat', message['chat']['id'])
+    return None
+
+
+class LatencyTracker:
+    """Matches each addressed update with the first reply the fake Bot API sees for it.
+
+    Replies are matched per chat in arrival order, so a scheduled phrase sent while a
+    mention is waiting counts as that mention's reply; replies with nothing waiting are
+    counted as unsolicited.
+    """
+
+    def __init__(self):
+        self.waiting = defaultdict(deque)
+        self.samples = []
+        self.unsolicited = 0
+
+    def expect(self, key, offset):
+        self.waiting[key].append((time.perf_counter(), offset))
+
+    def on_call(self, api_method, params):
+        if api_method not in REPLY_METHODS:
+            return
+        if api_method == 'answerCallbackQuery':
+            key = ('callback', str(params.get('callback_query_id')))
+        else:
+            key = ('chat', params.get('chat_id'))
+        waiting = self.waiting.get(key)
+        if not waiting:
+            self.unsolicited += 1
+            return
+        enqueued, offset = waiting.popleft()
+        if not waiting:
+            del self.waiting[key]
+        self.samples.append((offset, (time.perf_counter() - enqueued) * 1000))
+
+    def pending(self):
+        return sum(map(len, self.waiting.values()))
+
+
+def by_window(samples, duration, windows):
+    # Latency over successive slices of the recording shows whether the bot falls behind as load builds up.
+    width = max(duration, 1e-9) / windows
+    slices = defaultdict(list)
+    for offset, latency in samples:
+        slices[min(int(offset / width), windows - 1)].append(latency)
+    return [
+        {'from_s': round(i * width, 3), 'replies': len(slices[i]), **percentiles(slices[i])}
+        for i in range(windows)
+    ]
+
+
+async def open_database(args):
+    if args.memory:
+        return MemoryDatabase(), None
+    from motor.motor_asyncio import AsyncIOMotorClient
+    client = AsyncIOMotorClient(args.mongo_uri)
+    await client.drop_database(args.database)
+    return client[args.database], client
+
+
+async def seed_phrases(db, count):
+    from phrase_store import DEFAULT_LISTS
+    for entry in DEFAULT_LISTS:
+        await db[entry['collection']].insert_many(
+            [{'phrase': f"{entry['_id']} фраза номер {i}"} for i in range(count // len(DEFAULT_LISTS))]
+        )
+
+
+def idle(bot, application):
+    return (
+        application.update_queue.empty()
+        and application.update_processor.current_concurrent_updates == 0
+        and not bot.deliveries
+    )
+
+
+async def replay(args, identity, recorded, speed):
+    from bot import MitekBot
+
+    db, client = await open_database(args)
+    await seed_phrases(db, args.phrases)
+    bot = MitekBot(db=db)
+    if args.no_rate_limits:
+        bot.outbound.global_rate = bot.outbound.group_rate = bot.outbound.chat_rate = 1e6
+        bot.outbound.group_burst = 1e6
+    tracker = LatencyTracker()
+    api = FakeBotAPI(args.api_latency, identity['id'], identity['username'], tracker.on_call)
+    application = bot.build_application(TOKEN, request=api)
+
+    async with application:
+        await bot.post_init(application)
+        await application.start()
+        updates = [(offset, Update.de_json(payload, application.bot), addressed_key(payload, identity))
+                   for offset, payload in recorded]
+
+        loop = asyncio.get_running_loop()
+        lags = []
+        started = loop.time()
+        for offset, update, key in updates:
+            due = started + offset / speed
+            delay = due - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            lags.append((loop.time() - due) * 1000)
+            if key:
+                tracker.expect(key, offset)
+            application.update_queue.put_nowait(update)
+        fed = loop.time() - started
+
+        deadline = loop.time() + args.drain
+        while loop.time() < deadline and not (idle(bot, application) and not tracker.pending()):
+            await asyncio.sleep(0.01)
+        elapsed = loop.time() - started
+
+        outbound = bot.outbound.stats()
+        await application.stop()
+        await bot.post_shutdown(application)
+    if client:
+        client.close()
+
+    duration = recorded[-1][0] if recorded else 0
+    return {
+        'speed': speed,
+        'updates': len(updates),
+        'recorded_seconds': duration,
+        'replay_seconds': elapsed,
+        'updates_per_sec': len(updates) / elapsed if elapsed else 0,
+        'latency_ms': percentiles([latency for _, latency in tracker.samples]),
+        'feeder_lag_ms': percentiles(lags),
+        'replies': len(tracker.samples),
+        'unanswered': tracker.pending(),
+        'unsolicited': tracker.unsolicited,
+        'fed_seconds': fed,
+        'windows': by_window(tracker.samples, duration, args.windows),
+        'api_calls': dict(api.calls),
+        'outbound': outbound,
+    }
+
+
+def report(result):
+    latency = ' '.join(f'{key}={value:.1f}' for key, value in result['latency_ms'].items())
+    print(f"x{result['speed']:<6g} {result['updates']} updates in {result['replay_seconds']:.1f}s "
+          f"({result['updates_per_sec']:.0f}/s), reply latency ms: {latency or 'n/a'}, "
+          f"replies={result['replies']} unanswered={result['unanswered']} unsolicited={result['unsolicited']}, "
+          f"feeder lag p99={result['feeder_lag_ms'].get('p99', 0):.1f}ms")
+    for window in result['windows']:
+        if window['replies']:
+            print(f"    from {window['from_s']:>8.1f}s  replies={window['replies']:<5} "
+                  f"p50={window['p50']:.1f} p95={window['p95']:.1f} max={window['max']:.1f}")
+
+
+def main(args):
+    if not args.memory and args.database == 'telegram_bot':
+        sys.exit("Refusing to replay into the production database, pick another --database")
+    identity, recorded = load_recording(args.recording, args.max_gap)
+    if identity is None:
+        sys.exit(f"{args.recording} has no bot header, is it a RECORD_UPDATES file?")
+
+    logging.basicConfig(level=logging.WARNING)
+    os.environ.setdefault('LOG_FILE', os.path.join(tempfile.mkdtemp(prefix='mitek-replay-'), 'bot.log'))
+    os.environ['PHRASE_INDEX_DIR'] = tempfile.mkdtemp(prefix='mitek-replay-')
+    users = {(payload.get('message') or payload.get('callback_query') or {}).get('from', {}).get('id')
+             for _, payload in recorded}
+    if args.allow_recorded_users:
+        os.environ['ALLOWED_USER_IDS'] = ','.join(str(user_id) for user_id in users if user_id)
+    os.environ.setdefault('ALLOWED_USER_IDS', '0')
+
+    results = []
+    for speed in args.speed:
+        result = asyncio.run(replay(args, identity, recorded, speed))
+        report(result)
+        results.append(result)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay a RECORD_UPDATES file through MitekBot against a fake Bot API.")
+    parser.add_argument('recording')
+    parser.add_argument('--speed', nargs='+', type=float, default=[1, 10, 100])
+    parser.add_argument('--memory', action='store_true', help="use the in-memory Mongo stand-in")
+    parser.add_argument('--mongo-uri', default='mongodb://127.0.0.1:27017/')
+    parser.add_argument('--database', default='mitek_replay', help="dropped before every run")
+    parser.add_argument('--phrases', type=int, default=10000)
+    parser.add_argument('--api-latency', type=float, default=0.05, help="seconds per fake Bot API call")
+    parser.add_argument('--max-gap', type=float, default=10, help="cut idle gaps in the recording to this many seconds")
+    parser.add_argument('--windows', type=int, default=10)
+    parser.add_argument('--drain', type=float, default=30, help="seconds to wait for replies after the last update")
+    parser.add_argument('--allow-recorded-users', action='store_true',
+                        help="treat every sender in the recording as an allowed user")
+    parser.add_argument('--no-rate-limits', action='store_true')
+    parser.add_argument('--json', help="write results to this file")
+    args = parser.parse_args()
+
+    results = main(args)
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
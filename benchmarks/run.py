@@ -0,0 +1,293 @@
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from telegram import Update
+
+from benchmarks.fakes import BOT_USERNAME, FakeBotAPI, MemoryDatabase
+
+ALLOWED_USER_ID = 1
+TOKEN = '123456:benchmark'
+
+
+def percentiles(samples):
+    if not samples:
+        return {}
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]
+    return {'p50': pick(0.50), 'p95': pick(0.95), 'p99': pick(0.99), 'max': samples[-1]}
+
+
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def make_bot(db):
+    from bot import MitekBot
+    bot = MitekBot(db=db)
+    bot.outbound.global_rate = bot.outbound.group_rate = bot.outbound.chat_rate = 1e6
+    bot.outbound.group_burst = 1e6
+    return bot
+
+
+def fill_phrases(db, count):
+    for name, share in (('phrases_list_1', count // 2), ('phrases_list_2', count - count // 2)):
+        collection = db[name]
+        for i in range(1, share + 1):
+            collection.docs[i] = {'_id': i, 'phrase': f'{name} phrase number {i}'}
+
+
+async def bench_selection(size, picks, chats):
+    db = MemoryDatabase()
+    fill_phrases(db, size)
+    started = time.perf_counter()
+    bot = make_bot(db)
+    await bot.phrases.load()
+    load_seconds = time.perf_counter() - started
+
+    latencies = []
+    started = time.perf_counter()
+    for i in range(picks):
+        chat_id = -(i % chats) - 1
+        phrase_type = 'хуйня' if i % 2 else None
+        pick_started = time.perf_counter_ns()
+        await bot.select_random_phrase(chat_id, phrase_type)
+        latencies.append((time.perf_counter_ns() - pick_started) / 1000)
+    elapsed = time.perf_counter() - started
+
+    reply_latencies = []
+    texts = [f'phrases_list_1 phrase number {random.randrange(size)} ну и что' for _ in range(min(picks, 10000))]
+    reply_started = time.perf_counter()
+    for i, text in enumerate(texts):
+        pick_started = time.perf_counter_ns()
+        await bot.select_random_phrase(-(i % chats) - 1, bot.reply_list, text)
+        reply_latencies.append((time.perf_counter_ns() - pick_started) / 1000)
+    reply_elapsed = time.perf_counter() - reply_started
+
+    return {
+        f'select_random_phrase/{size}': {
+            'unit': 'us',
+            **percentiles(latencies),
+            'ops_per_sec': picks / elapsed,
+            'load_seconds': load_seconds,
+        },
+        f'select_reply_phrase/{size}': {
+            'unit': 'us',
+            **percentiles(reply_latencies),
+            'ops_per_sec': len(texts) / reply_elapsed,
+        },
+    }
+
+
+def make_update(update_id, chat_id, user_id, text, reply_to_bot=False):
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'supergroup', 'title': 'bench'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'user'},
+        'text': text,
+    }
+    if text.startswith('@'):
+        message['entities'] = [{'type': 'mention', 'offset': 0, 'length': len(BOT_USERNAME) + 1}]
+    if reply_to_bot:
+        message['reply_to_message'] = {
+            'message_id': 1,
+            'date': int(time.time()),
+            'chat': message['chat'],
+            'from': {'id': 777000, 'is_bot': True, 'first_name': 'Mitek', 'username': BOT_USERNAME},
+            'text': 'earlier phrase',
+        }
+    return {'update_id': update_id, 'message': message}
+
+
+def make_traffic(count, chats, mention_share):
+    payloads = []
+    for i in range(count):
+        chat_id = -(random.randrange(chats)) - 1
+        if random.random() < mention_share:
+            payloads.append(make_update(i + 1, chat_id, ALLOWED_USER_ID, f'@{BOT_USERNAME} ну что скажешь?'))
+        else:
+            user_id = random.choice([ALLOWED_USER_ID, 1000 + random.randrange(500)])
+            payloads.append(make_update(i + 1, chat_id, user_id, f'обычное сообщение {i} в группе'))
+    return payloads
+
+
+async def bench_ingestion(count, chats, mention_share):
+    db = MemoryDatabase()
+    fill_phrases(db, 10000)
+    bot = make_bot(db)
+    api = FakeBotAPI()
+    application = bot.build_application(TOKEN, request=api)
+    payloads = make_traffic(count, chats, mention_share)
+
+    async with application:
+        await bot.post_init(application)
+        updates = [Update.de_json(payload, application.bot) for payload in payloads]
+        latencies = {True: [], False: []}
+        started = time.perf_counter()
+        for update in updates:
+            update_started = time.perf_counter_ns()
+            await application.process_update(update)
+            latencies[update.message.text.startswith('@')].append((time.perf_counter_ns() - update_started) / 1000)
+        sequential = time.perf_counter() - started
+
+        updates = [Update.de_json(payload, application.bot) for payload in make_traffic(count, chats, mention_share)]
+        processor = application.update_processor
+        started = time.perf_counter()
+        await asyncio.gather(*(processor.process_update(update, application.process_update(update)) for update in updates))
+        concurrent = time.perf_counter() - started
+
+        outbound = bot.outbound.stats()
+        histories = bot.chat_last_messages.values()
+        history_bytes = sum(history.nbytes() for history in histories) / max(1, len(histories))
+        await bot.post_shutdown(application)
+
+    return {
+        'track_message': {
+            'unit': 'us',
+            **percentiles(latencies[False]),
+            'updates_per_sec': count / sequential,
+            'concurrent_updates_per_sec': count / concurrent,
+            'api_calls': dict(api.calls),
+            'outbound': outbound,
+            'history_bytes_per_chat': history_bytes,
+        },
+        'mention_or_reply': {
+            'unit': 'us',
+            **percentiles(latencies[True]),
+        },
+    }
+
+
+async def bench_scheduling(chats, duration):
+    db = MemoryDatabase()
+    fill_phrases(db, 10000)
+    bot = make_bot(db)
+    api = FakeBotAPI()
+    application = bot.build_application(TOKEN, request=api)
+    bot.TYPING_REFRESH = 0.5
+
+    async with application:
+        await bot.post_init(application)
+        loop = asyncio.get_running_loop()
+        scheduler = bot.scheduler
+        lags = []
+        fire = scheduler.fire
+
+        def timed_fire(chat_id):
+            lags.append((loop.time() - scheduler.entries[chat_id][0]) * 1000)
+            fire(chat_id)
+
+        scheduler.fire = timed_fire
+        started = time.perf_counter()
+        for i in range(chats):
+            chat_id = -i - 1
+            bot.chat_intervals[chat_id] = (1, 2)
+            scheduler.start(chat_id)
+        await asyncio.sleep(duration)
+        elapsed = time.perf_counter() - started
+        sent = len(api.sent)
+        await bot.post_shutdown(application)
+
+    return {
+        f'scheduler/{chats}': {
+            'unit': 'ms lag',
+            **percentiles(lags),
+            'fires_per_sec': len(lags) / elapsed,
+            'messages_per_sec': sent / elapsed,
+        }
+    }
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if not previous:
+            continue
+        for key in ('p95', 'p99'):
+            if key in previous and current.get(key, 0) > previous[key] * (1 + tolerance):
+                regressions.append(f'{name} {key}: {previous[key]:.1f} -> {current[key]:.1f} {current["unit"]}')
+        for key in ('ops_per_sec', 'updates_per_sec', 'fires_per_sec'):
+            if key in previous and current.get(key, 0) < previous[key] * (1 - tolerance):
+                regressions.append(f'{name} {key}: {previous[key]:.0f} -> {current[key]:.0f}')
+    return regressions
+
+
+def report(results):
+    for name, result in results.items():
+        latency = ' '.join(f'{key}={result[key]:.1f}' for key in ('p50', 'p95', 'p99', 'max') if key in result)
+        rates = ' '.join(f'{key}={value:.0f}' for key, value in result.items() if key.endswith('_per_sec'))
+        memory = f" rss+={result['peak_rss_growth_bytes'] / 2**20:.1f}MiB"
+        print(f'{name:32} [{result["unit"]}] {latency} {rates}{memory}')
+
+
+def run_scenario(seed, scenario, *args):
+    # Each scenario runs in a fresh process so its peak RSS is not hidden by an earlier one.
+    logging.basicConfig(level=logging.WARNING)
+    os.environ.setdefault('ALLOWED_USER_IDS', str(ALLOWED_USER_ID))
+    os.environ['PHRASE_INDEX_DIR'] = tempfile.mkdtemp(prefix='mitek-bench-')
+    random.seed(seed)
+    baseline = peak_rss()
+    results = asyncio.run(scenario(*args))
+    for result in results.values():
+        result['peak_rss_bytes'] = peak_rss()
+        result['peak_rss_growth_bytes'] = peak_rss() - baseline
+    return results
+
+
+def main(args):
+    scenarios = []
+    if 'selection' in args.only:
+        scenarios += [(bench_selection, size, args.picks, args.chats) for size in args.phrases]
+    if 'ingestion' in args.only:
+        scenarios.append((bench_ingestion, args.updates, args.chats, args.mention_share))
+    if 'scheduling' in args.only:
+        scenarios.append((bench_scheduling, args.scheduled_chats, args.duration))
+
+    results = {}
+    context = multiprocessing.get_context('spawn')
+    for scenario in scenarios:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            results.update(executor.submit(run_scenario, args.seed, *scenario).result())
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Offline benchmarks for MitekBot hot paths.")
+    parser.add_argument('--only', nargs='+', default=['selection', 'ingestion', 'scheduling'],
+                        choices=['selection', 'ingestion', 'scheduling'])
+    parser.add_argument('--phrases', nargs='+', type=int, default=[1000, 10000, 100000])
+    parser.add_argument('--picks', type=int, default=100000)
+    parser.add_argument('--chats', type=int, default=1000)
+    parser.add_argument('--updates', type=int, default=20000)
+    parser.add_argument('--mention-share', type=float, default=0.02)
+    parser.add_argument('--scheduled-chats', type=int, default=10000)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="write results to this file")
+    parser.add_argument('--baseline', help="fail if results regress against this earlier --json output")
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    results = main(args)
+    report(results)
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        sys.exit(1 if regressions else 0)
@@ -1,6 +1,12 @@
 import logging
 import asyncio
+import hashlib
+import json
+import math
 import os
+import signal
+import socket
+import time
 from telegram import (
     Update, 
     Bot,
@@ -10,195 +16,318 @@ from telegram import (
     BotCommandScopeDefault,
     BotCommandScopeAllGroupChats
 )
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     ApplicationBuilder,
+    CallbackContext,
     CommandHandler, 
     ContextTypes,
     ConversationHandler,
     CallbackQueryHandler,
     MessageHandler, 
+    TypeHandler,
     filters
 )
 from dotenv import load_dotenv
 import random
 from motor.motor_asyncio import AsyncIOMotorClient
-from collections import deque
+from phrase_store import PhraseStore
+from scheduler import ChatScheduler
+from state_store import ChatStateStore
+from media_cache import MediaCache
+from message_history import MessageHistory, fingerprint
+from update_processor import ChatOrderedUpdateProcessor
+from outbound import OutboundDispatcher, REPLY, SCHEDULED, BACKGROUND
+from metrics import Metrics
+from log_setup import parse_sampling, setup_logging
+from chat_leases import ChatLeases
+from update_recorder import UpdateRecorder
+from addressing import AddressedToBot
+
+message_log = logging.getLogger('mitek.messages')
 
 class MitekBot:
     MAIN, ADDING_PHRASE, CHOOSING_LIST, DELETING_COLLECTION, SETTING_INTERVAL, SETTING_WEIGHTS = range(6)
+    TYPING_REFRESH = 4
 
-    def __init__(self):
+    def __init__(self, db=None):
+        self.started = time.monotonic()
+        self.time_to_ready = None
         load_dotenv()
-        logging.basicConfig(
-            format='%(asctime)s | %(name)s | %(levelname)s | %(message)s', 
-            level=logging.INFO,
-            handlers=[
-                logging.FileHandler("bot.log"),
-                logging.StreamHandler()
-            ]
+        self.log_handler = setup_logging(
+            path=os.environ.get('LOG_FILE', 'bot.log'),
+            level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
+            max_bytes=int(os.environ.get('LOG_MAX_BYTES', 10 * 2**20)),
+            interval=int(os.environ.get('LOG_ROTATE_INTERVAL', 24 * 3600)),
+            backup_count=int(os.environ.get('LOG_BACKUP_COUNT', 7)),
+            queue_size=int(os.environ.get('LOG_QUEUE_SIZE', 10000)),
+            sampling=parse_sampling(os.environ.get('LOG_SAMPLING', 'mitek.messages=0.1')),
         )
 
         logging.getLogger("telegram").setLevel(logging.WARNING)
         logging.getLogger("telegram.ext").setLevel(logging.WARNING)
         logging.getLogger("httpx").setLevel(logging.WARNING)
 
-        self.MONGO_URI = 'mongodb://127.0.0.1:27017/'
-        self.client = AsyncIOMotorClient(self.MONGO_URI)
-        self.db = self.client['telegram_bot']
-        self.collection_1 = self.db['phrases_list_1']
-        self.collection_2 = self.db['phrases_list_2']
+        self.metrics = Metrics(
+            enabled=bool(os.environ.get('METRICS_PORT')),
+            host=os.environ.get('METRICS_HOST', '127.0.0.1'),
+            port=int(os.environ.get('METRICS_PORT') or 9090),
+        )
+
+        self.MONGO_URI = os.environ.get('MONGO_URI', 'mongodb://127.0.0.1:27017/')
+        if db is None:
+            self.client = AsyncIOMotorClient(
+                self.MONGO_URI,
+                event_listeners=self.metrics.mongo_listeners(),
+                minPoolSize=int(os.environ.get('MONGO_MIN_POOL_SIZE', 4)),
+            )
+            db = self.client['telegram_bot']
+        else:
+            self.client = None
+        self.db = db
+        self.phrases = PhraseStore(
+            self.db,
+            window=int(os.environ.get('PHRASE_NO_REPEAT_WINDOW', 20)),
+            max_histories=int(os.environ.get('PHRASE_HISTORY_LIMIT', 10000)),
+            cache_limit=int(os.environ.get('PHRASE_CACHE_LIMIT', 200000)),
+            index_dir=os.environ.get('PHRASE_INDEX_DIR', 'phrase_index') or None,
+            top_k=int(os.environ.get('REPLY_TOP_K', 20)),
+        )
+        self.reply_list = os.environ.get('REPLY_PHRASE_LIST', 'хуйня')
 
         self.ALLOWED_USER_IDS = set(
             map(int, os.environ.get('ALLOWED_USER_IDS').split(',')
             )
         )
 
-        self.scheduled_tasks = {}
+        self.application = None
+        self.deliveries = {}
+        self.send_global_rate = float(os.environ.get('SEND_GLOBAL_RATE', 30))
+        self.outbound = OutboundDispatcher(
+            global_rate=self.send_global_rate,
+            group_rate=float(os.environ.get('SEND_GROUP_RATE', 20)) / 60,
+            max_queue=int(os.environ.get('SEND_QUEUE_LIMIT', 10000)),
+        )
+        self.scheduler = ChatScheduler(self.send_scheduled_phrase, self.get_interval)
         self.chat_states = {}
         self.chat_intervals = {} 
         self.chat_last_messages = {}
+        self.history_depth = int(os.environ.get('MESSAGE_HISTORY_DEPTH', 10))
+        if self.history_depth < 1:
+            logging.warning("MESSAGE_HISTORY_DEPTH must be at least 1, using 1")
+            self.history_depth = 1
         self.chat_weights = {}
-        self.recent_phrases = {}
-        
-        self.marsh = './marsh.mp3'
-        if not os.path.exists(self.marsh):
-            raise ValueError("Marsh has to be present in same dir")
+        self.chat_list_weights = {}
+        self.state_store = ChatStateStore(
+            self.db['chat_state'],
+            self.snapshot_chat,
+            flush_interval=float(os.environ.get('STATE_FLUSH_INTERVAL', 5)),
+        )
+        self.addressed = AddressedToBot()
+        self.recorder = UpdateRecorder(os.environ['RECORD_UPDATES']) if os.environ.get('RECORD_UPDATES') else None
+        self.running_chats = set()
+        # A worker only runs the schedulers of the chats it holds a lease on; updates are
+        # received by the polling/webhook process, which can hold leases too.
+        self.receives_updates = os.environ.get('BOT_MODE', 'polling') != 'worker'
+        if not self.receives_updates or os.environ.get('CHAT_LEASES'):
+            self.leases = ChatLeases(
+                self.db,
+                self.state_store.collection,
+                os.environ.get('WORKER_ID') or f'{socket.gethostname()}:{os.getpid()}',
+                self.acquire_chat,
+                self.release_chats,
+                self.rebalance_chats,
+                ttl=int(os.environ.get('LEASE_TTL', 30)),
+            )
+        else:
+            self.leases = None
+
+        self.media = MediaCache(self.db['media'])
+        for clip in filter(None, (part.strip() for part in os.environ.get('VOICE_CLIPS', 'marsh=./marsh.mp3').split(','))):
+            name, path = clip.split('=', 1)
+            self.media.register(name.strip(), path.strip())
+
+        self.metrics.gauge('mitek_scheduled_chats', "Chats with a running scheduler", lambda: len(self.scheduler))
+        self.metrics.gauge('mitek_pending_deliveries', "Phrases being typed", lambda: sum(map(len, self.deliveries.values())))
+        self.metrics.gauge('mitek_outbound_queue_depth', "Queued outbound sends", self.outbound.depth)
+        for counter in self.outbound.counters:
+            self.metrics.gauge(
+                f'mitek_outbound_{counter}_total', f"Outbound sends {counter}",
+                lambda counter=counter: self.outbound.counters[counter], kind='counter',
+            )
+        self.metrics.gauge(
+            'mitek_message_history_bytes', "Memory held by per-chat message histories",
+            lambda: sum(history.nbytes() for history in self.chat_last_messages.values()),
+        )
+        self.metrics.gauge('mitek_time_to_ready_seconds', "Seconds from start until updates are served", lambda: self.time_to_ready or 0)
+        if self.leases:
+            self.metrics.gauge('mitek_leased_chats', "Chats this worker holds a lease on", lambda: len(self.leases.owned))
+        if self.log_handler:
+            self.metrics.gauge(
+                'mitek_log_dropped_total', "Log records dropped because the writer fell behind",
+                lambda: self.log_handler.dropped, kind='counter',
+            )
         
     async def check_user_name(self, update: Update):
         user = update.effective_user
         if user.id in self.ALLOWED_USER_IDS:
             return True
-        await update.message.reply_text("You are not authorized to use this bot.")
+        self.outbound.submit(
+            update.effective_chat.id,
+            lambda: update.message.reply_text("You are not authorized to use this bot."),
+            priority=REPLY,
+            coalesce_key=('unauthorized', update.effective_chat.id),
+        )
         return False
     
+    async def reply(self, update, text, **kwargs):
+        # Command replies share the dispatcher's rate limits and flood handling with every other send.
+        await self.outbound.submit(
+            update.effective_chat.id, lambda: update.message.reply_text(text, **kwargs), priority=REPLY,
+        )
+
+    async def edit_reply(self, query, text):
+        await self.outbound.submit(query.message.chat_id, lambda: query.edit_message_text(text), priority=REPLY)
+
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         chat_id = update.effective_chat.id
         self.chat_states[chat_id] = self.MAIN
         
-        if not self.chat_last_messages.get(chat_id, None):
-            self.chat_last_messages[chat_id] = deque(maxlen=10)
-        
-        if not self.recent_phrases.get(chat_id, None):
-            self.recent_phrases[chat_id] = deque(maxlen=20) 
+        if chat_id not in self.chat_last_messages:
+            self.chat_last_messages[chat_id] = MessageHistory(self.history_depth)
             
         if not await self.check_user_name(update):
             return ConversationHandler.END
         
-        if chat_id in self.scheduled_tasks:
-            await update.message.reply_text("Митек уже в работе.")
+        if chat_id in self.running_chats:
+            await self.reply(update, "Митек уже в работе.")
             return ConversationHandler.END
             
-        await context.bot.send_message(chat_id=chat_id, text="Митек завелся. Митек поехал.")
-        task = asyncio.create_task(self.schedule_phrases(context, chat_id))
-        self.scheduled_tasks[chat_id] = task
+        await self.outbound.submit(chat_id, lambda: context.bot.send_message(chat_id=chat_id, text="Митек завелся. Митек поехал."), priority=REPLY)
+        self.running_chats.add(chat_id)
+        if self.owns(chat_id):
+            self.scheduler.start(chat_id)
+        await self.save_chat(chat_id)
         return self.MAIN
     
     async def stop(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         chat_id = update.effective_chat.id
         if not await self.check_user_name(update):
             return ConversationHandler.END
-        task = self.scheduled_tasks.get(chat_id)
-        if task:
-            task.cancel()
-            del self.scheduled_tasks[chat_id]
-            await context.bot.send_message(chat_id=chat_id, text="Митек остановлен.")
-        else:
-            await context.bot.send_message(chat_id=chat_id, text="Митек не был запущен.")
-        del self.chat_states[chat_id]
+        self.cancel_deliveries(chat_id)
+        self.scheduler.stop(chat_id)
+        text = "Митек остановлен." if chat_id in self.running_chats else "Митек не был запущен."
+        self.running_chats.discard(chat_id)
+        await self.outbound.submit(chat_id, lambda: context.bot.send_message(chat_id=chat_id, text=text), priority=REPLY)
+        self.chat_states.pop(chat_id, None)
+        await self.save_chat(chat_id)
         return self.MAIN
 
+    def owns(self, chat_id):
+        return self.leases is None or chat_id in self.leases
+
+    async def save_chat(self, chat_id):
+        self.state_store.mark(chat_id)
+        if self.leases:
+            # Another worker may own the chat; let it see the change on its next rebalance.
+            await self.state_store.flush()
+
     async def add_phrases(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not await self.check_user_name(update):
             return ConversationHandler.END
         
         if update.message.chat.type in ['group', 'supergroup']:
             if len(context.args) < 2:
-                await update.message.reply_text("Использование: /add_phrases <список> <фраза>")
+                await self.reply(update, "Использование: /add_phrases <список> <фраза>")
                 return self.MAIN
 
             list_name = context.args[0].lower()
             phrase = " ".join(context.args[1:])
             
-            if list_name == 'хуйня':
-                await self.collection_1.insert_one({'phrase': phrase})
-            elif list_name == 'цитаты':
-                await self.collection_2.insert_one({'phrase': phrase})
-            else:
-                await update.message.reply_text("Неверное имя списка. Используйте 'хуйня' или 'цитаты'.")
+            if list_name not in self.phrases:
+                await self.reply(update, f"Неверное имя списка. Используйте {self.list_choices()}.")
                 return self.MAIN
             
-            await update.message.reply_text(f'Добавлено в {list_name}: "{phrase}"')
+            if not await self.phrases.add(list_name, phrase):
+                await self.reply(update, f'Уже есть в {list_name}: "{phrase}"')
+                return self.MAIN
+            await self.reply(update, f'Добавлено в {list_name}: "{phrase}"')
             return self.MAIN
 
-        await update.message.reply_text("Добавь фразу для МитGPT.")
+        await self.reply(update, "Добавь фразу для МитGPT.")
         return self.ADDING_PHRASE
     
 
     async def ask_list(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data['new_phrase'] = update.message.text
-        keyboard = [
-            [InlineKeyboardButton("Хуйня", callback_data='add_хуйня'),
-             InlineKeyboardButton("Цитаты", callback_data='add_цитаты')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text("Добавить фразу в хуйню или цитаты?", reply_markup=reply_markup)
+        reply_markup = self.list_keyboard('add_')
+        await self.reply(update, f"Добавить фразу в {self.list_choices()}?", reply_markup=reply_markup)
         return self.CHOOSING_LIST
 
     async def add_phrase_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = update.callback_query
         await query.answer()
-        list_name = query.data.split('_')[1]
+        list_name = query.data.split('_', 1)[1]
         phrase = context.user_data.get('new_phrase')
         
-        if list_name == 'хуйня':
-            await self.collection_1.insert_one({'phrase': phrase})
-        elif list_name == 'цитаты':
-            await self.collection_2.insert_one({'phrase': phrase})
+        if list_name not in self.phrases or not phrase:
+            await self.edit_reply(query, "Неверное имя списка.")
+            return self.MAIN
         
-        await query.edit_message_text(f'Добавлено в {list_name}: "{phrase}"')
+        if not await self.phrases.add(list_name, phrase):
+            await self.edit_reply(query, f'Уже есть в {list_name}: "{phrase}"')
+            return self.MAIN
+        await self.edit_reply(query, f'Добавлено в {list_name}: "{phrase}"')
         return self.MAIN
 
+    def list_choices(self):
+        return ' или '.join(f"'{name}'" for name in self.phrases.names())
+
+    def list_keyboard(self, prefix):
+        return InlineKeyboardMarkup([[
+            InlineKeyboardButton(self.phrases.labels[name], callback_data=f'{prefix}{name}')
+            for name in self.phrases.names()
+        ]])
+
     async def delete_recent_phrase(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not await self.check_user_name(update):
             return ConversationHandler.END
 
         if update.message.chat.type in ['group', 'supergroup']:
             if len(context.args) < 1:
-                await update.message.reply_text("Использование: /delete_recent_phrase <список>")
+                await self.reply(update, "Использование: /delete_recent_phrase <список>")
                 return self.MAIN
             
             list_name = context.args[0].lower()
-            collection = self.collection_1 if list_name == 'хуйня' else self.collection_2
+            if list_name not in self.phrases:
+                await self.reply(update, f"Неверное имя списка. Используйте {self.list_choices()}.")
+                return self.MAIN
             
-            recent_phrase = await collection.find_one(sort=[('_id', -1)])
+            recent_phrase = await self.phrases.delete_recent(list_name)
             if recent_phrase:
-                await collection.delete_one({'_id': recent_phrase['_id']})
-                await update.message.reply_text(f'Удалено из {list_name}: "{recent_phrase["phrase"]}"')
+                await self.reply(update, f'Удалено из {list_name}: "{recent_phrase}"')
             else:
-                await update.message.reply_text(f'В {list_name} нет нихуя.')
+                await self.reply(update, f'В {list_name} нет нихуя.')
             return self.MAIN
 
-        keyboard = [
-            [InlineKeyboardButton("Хуйня", callback_data='delete_хуйня'),
-            InlineKeyboardButton("Цитаты", callback_data='delete_цитаты')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text("Откуда удалить последнюю фразу?", reply_markup=reply_markup)
+        reply_markup = self.list_keyboard('delete_')
+        await self.reply(update, "Откуда удалить последнюю фразу?", reply_markup=reply_markup)
         return self.MAIN
 
     async def delete_phrase_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = update.callback_query
         await query.answer()
         
-        list_name = query.data.split('_')[1]
-        collection = self.collection_1 if list_name == 'хуйня' else self.collection_2
+        list_name = query.data.split('_', 1)[1]
+        if list_name not in self.phrases:
+            await self.edit_reply(query, "Неверное имя списка.")
+            return self.MAIN
 
-        recent_phrase = await collection.find_one(sort=[('_id', -1)])
+        recent_phrase = await self.phrases.delete_recent(list_name)
         if recent_phrase:
-            await collection.delete_one({'_id': recent_phrase['_id']})
-            await query.edit_message_text(f'Удалено из {list_name}: "{recent_phrase["phrase"]}"')
+            await self.edit_reply(query, f'Удалено из {list_name}: "{recent_phrase}"')
         else:
-            await query.edit_message_text(f'В {list_name} нет нихуя.')
+            await self.edit_reply(query, f'В {list_name} нет нихуя.')
         return self.MAIN
 
     async def set_interval_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -210,15 +339,17 @@ class MitekBot:
             try:
                 min_val, max_val = map(int, context.args)
                 if min_val > 0 and max_val >= min_val:
-                    self.chat_intervals[chat_id] = (min_val, max_val)  
-                    await update.message.reply_text(f'Интервал установлен на {min_val} - {max_val} секунд.')
+                    self.chat_intervals[chat_id] = (min_val, max_val)
+                    self.scheduler.reschedule(chat_id)
+                    self.state_store.mark(chat_id)
+                    await self.reply(update, f'Интервал установлен на {min_val} - {max_val} секунд.')
                 else:
-                    await update.message.reply_text('Введи секунды от и до.')
+                    await self.reply(update, 'Введи секунды от и до.')
             except (ValueError, IndexError):
-                await update.message.reply_text('Использование: /set_interval <min> <max>')
+                await self.reply(update, 'Использование: /set_interval <min> <max>')
             return self.MAIN
 
-        await update.message.reply_text("Временной интервал запуска в формате: <min> <max>.")
+        await self.reply(update, "Временной интервал запуска в формате: <min> <max>.")
         return self.SETTING_INTERVAL
 
     async def set_interval(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -227,91 +358,146 @@ class MitekBot:
             min_val, max_val = map(int, update.message.text.split())
             if min_val > 0 and max_val >= min_val:
                 self.chat_intervals[chat_id] = (min_val, max_val)
-                await update.message.reply_text(f'Интервал установлен на {min_val} - {max_val} секунд.')
+                self.scheduler.reschedule(chat_id)
+                self.state_store.mark(chat_id)
+                await self.reply(update, f'Интервал установлен на {min_val} - {max_val} секунд.')
             else:
-                await update.message.reply_text('Введи секунды от и до.')
+                await self.reply(update, 'Введи секунды от и до.')
                 return self.SETTING_INTERVAL
         except ValueError:
-            await update.message.reply_text('Числа блять!!!')
+            await self.reply(update, 'Числа блять!!!')
             return self.SETTING_INTERVAL
         return self.MAIN
 
     async def cancel(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.message.reply_text("Операция отменена.")
+        await self.reply(update, "Операция отменена.")
         return self.MAIN
 
-    async def select_random_phrase(self, context, chat_id, phrase_type=None):
-        phrases_1 = await self.collection_1.find().to_list(length=None)
-        phrases_2 = await self.collection_2.find().to_list(length=None)
-        if not phrase_type:
-            phrases = [doc['phrase'] for doc in phrases_1 + phrases_2]
-        elif phrase_type == 'хуйня':
-            phrases = [doc['phrase'] for doc in phrases_1]
-        elif phrase_type == 'цитаты':
-            phrases = [doc['phrase'] for doc in phrases_2]
-        if not phrases:
+    async def select_random_phrase(self, chat_id, phrase_type=None, reply_to_text=None):
+        if reply_to_text and phrase_type:
+            phrase = await self.phrases.pick_reply(chat_id, phrase_type, reply_to_text)
+        else:
+            phrase = await self.phrases.pick(chat_id, phrase_type, self.chat_list_weights.get(chat_id))
+        if not phrase:
             return 'Пиздец...'
-        
-        available_phrases = [phrase for phrase in phrases if phrase not in self.recent_phrases.get(chat_id, [])]
-
-        if not available_phrases:
-            self.recent_phrases[chat_id].clear()
-            available_phrases = phrases
-        
-        phrase = random.choices(available_phrases)[0]
-        self.recent_phrases[chat_id].append(phrase)
-        logging.info(f"Sending phrase '{phrase}'...")
-        await context.bot.send_chat_action(chat_id=chat_id, action='typing')
-        await asyncio.sleep(0.2 * len(phrase))
+        self.state_store.mark(chat_id)
         return phrase
 
+    async def deliver_phrase(self, bot, chat_id, phrase, reply_to_message_id=None, priority=SCHEDULED):
+        message_log.info("Sending phrase '%s' to chat %s", phrase, chat_id)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + 0.2 * len(phrase)
+        # A typing action lasts about 5 seconds, so keep refreshing it until the phrase is "typed".
+        while True:
+            self.outbound.submit(
+                chat_id,
+                lambda: bot.send_chat_action(chat_id=chat_id, action='typing'),
+                priority=BACKGROUND,
+                ttl=self.TYPING_REFRESH,
+                per_chat=False,
+            )
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            await asyncio.sleep(min(self.TYPING_REFRESH, remaining))
+            if loop.time() >= deadline:
+                break
+        await self.outbound.submit(
+            chat_id,
+            lambda: bot.send_message(chat_id=chat_id, text=phrase, reply_to_message_id=reply_to_message_id),
+            priority=priority,
+        )
+
+    def start_delivery(self, bot, chat_id, phrase, reply_to_message_id=None, priority=SCHEDULED):
+        task = asyncio.create_task(self.deliver_phrase(bot, chat_id, phrase, reply_to_message_id, priority))
+        tasks = self.deliveries.setdefault(chat_id, set())
+        tasks.add(task)
+        task.add_done_callback(lambda task: self.delivery_done(chat_id, task))
+        return task
+
+    def delivery_done(self, chat_id, task):
+        tasks = self.deliveries.get(chat_id)
+        if tasks is not None:
+            tasks.discard(task)
+            if not tasks:
+                del self.deliveries[chat_id]
+        if not task.cancelled() and task.exception():
+            logging.error("Failed to deliver phrase in chat %s", chat_id, exc_info=task.exception())
+
+    def cancel_deliveries(self, chat_id=None):
+        chats = [chat_id] if chat_id is not None else list(self.deliveries)
+        for chat in chats:
+            for task in list(self.deliveries.get(chat, ())):
+                task.cancel()
+
     async def send_phrase(self, context,  chat_id):
         weights = self.chat_weights.get(chat_id, [0.49, 0.49, 0.02]) 
         type_message = random.choices(['reply', 'quote', 'marsh'], weights=weights)[0]
-        if len(self.chat_last_messages[chat_id]) > 0 and type_message == 'reply':
+        if len(self.chat_last_messages.get(chat_id, ())) > 0 and type_message == 'reply':
             return await self.reply_random_phrase(context, chat_id)
-        if type_message == 'marsh':
+        if type_message == 'marsh' and self.media.names():
             return await self.send_marsh(context, chat_id)
         return await self.send_random_phrase(context, chat_id)
 
     async def send_random_phrase(self, context, chat_id: str):
-        phrase = await self.select_random_phrase(context, chat_id)
-        await context.bot.send_message(chat_id=chat_id, text=phrase)
+        phrase = await self.select_random_phrase(chat_id)
+        await self.start_delivery(context.bot, chat_id, phrase)
 
     async def reply_random_phrase(self, context, chat_id: str):
-        phrase = await self.select_random_phrase(context, chat_id, phrase_type='хуйня')
-        message_to_reply_to = random.choice(list(self.chat_last_messages[chat_id]))
-        await context.bot.send_message(chat_id=chat_id, text=phrase, reply_to_message_id=message_to_reply_to.message_id)
-
-    async def send_marsh(self, context, chat_id):   
-        await context.bot.send_voice(chat_id=chat_id, voice=open(self.marsh, 'rb'), caption="Поставь эту")
-
-    async def schedule_phrases(self, context, chat_id):
-        while True:
-            min_interval, max_interval = self.chat_intervals.get(chat_id, (1, 3600*6))
-            num = random.randint(min_interval, max_interval)
-            logging.info(f"Sending message in {num} seconds...")
-            await asyncio.sleep(num)
-            await self.send_phrase(context, chat_id)
-
-    async def mention_or_reply(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        message_id, text = self.chat_last_messages[chat_id].random_message()
+        phrase = await self.select_random_phrase(chat_id, phrase_type=self.reply_list, reply_to_text=text)
+        await self.start_delivery(context.bot, chat_id, phrase, reply_to_message_id=message_id)
+
+    async def send_marsh(self, context, chat_id):
+        clip = random.choice(self.media.names())
+        await self.outbound.submit(chat_id, lambda: self.media.send_voice(context.bot, chat_id, clip, caption="Поставь эту"))
+
+    def get_interval(self, chat_id):
+        return self.chat_intervals.get(chat_id, (1, 3600*6))
+
+    async def send_scheduled_phrase(self, chat_id):
+        if self.leases:
+            if chat_id not in self.leases:
+                # Released chats are stopped by release_chats; a lease whose renewal is late only
+                # skips this send and is rescheduled, or it would never run again once renewed.
+                if chat_id not in self.leases.owned:
+                    self.scheduler.stop(chat_id)
+                return
+            if not self.receives_updates:
+                # Settings and message history are written by the process receiving updates.
+                doc = await self.state_store.collection.find_one({'_id': chat_id})
+                if doc:
+                    self.restore_settings(doc)
+                if chat_id not in self.running_chats:
+                    self.scheduler.stop(chat_id)
+                    return
+        context = CallbackContext(self.application, chat_id=chat_id)
+        await self.send_phrase(context, chat_id)
+
+    async def status(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         chat_id = update.effective_chat.id
-        logging.info(f"Mention or reply detected in chat {chat_id}.")
         if not await self.check_user_name(update):
-            return
-        
-        if not self.recent_phrases.get(chat_id, None):
-            self.recent_phrases[chat_id] = deque(maxlen=20)
-        
-        reply = update.message.reply_to_message and update.message.reply_to_message.from_user.id == context.bot.id
-        mention = '@mitgptbot' in update.message.text and not update.message.text[0] == '/'
-        
-        if reply or mention:
-            logging.info(f"Reply or mention detected. Reply: {reply}, Mention: {mention}")
-            phrase = await self.select_random_phrase(context, chat_id, phrase_type='хуйня')
-            await context.bot.send_message(chat_id=chat_id, text=phrase, reply_to_message_id=update.message.message_id)
+            return ConversationHandler.END
+        next_in = self.scheduler.status(chat_id)
+        if chat_id not in self.running_chats:
+            await self.reply(update, "Митек не был запущен.")
+        elif next_in is None:
+            min_val, max_val = self.get_interval(chat_id)
+            await self.reply(update, f'Митек в работе на другом воркере. Интервал {min_val} - {max_val} секунд.')
         else:
-            logging.info("No reply or mention detected.")
+            min_val, max_val = self.get_interval(chat_id)
+            await self.reply(update, f'Митек в работе. Интервал {min_val} - {max_val} секунд, следующая фраза через {int(next_in)} секунд.')
+        return self.MAIN
+
+    async def mention_or_reply(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        # Only messages passing self.addressed get here.
+        chat_id = update.effective_chat.id
+        message = update.message
+        message_log.info("Reply or mention in chat %s from user %s: %.20s...", chat_id, update.effective_user.id, message.text)
+        if await self.check_user_name(update):
+            phrase = await self.select_random_phrase(chat_id, phrase_type=self.reply_list, reply_to_text=message.text)
+            self.start_delivery(context.bot, chat_id, phrase, reply_to_message_id=message.message_id, priority=REPLY)
+        await self.track_message(update, context)
 
     async def set_weights(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         chat_id = update.effective_chat.id
@@ -319,12 +505,13 @@ class MitekBot:
             reply_weight, quote_weight, marsh_weight = map(float, update.message.text.split())
             if reply_weight >= 0 and quote_weight >= 0 and marsh_weight >= 0 and reply_weight + quote_weight + marsh_weight == 1:
                 self.chat_weights[chat_id] = [reply_weight, quote_weight, marsh_weight]
-                await update.message.reply_text(f'Веса установлены на reply: {reply_weight}, quote: {quote_weight}, marsh: {marsh_weight}')
+                self.state_store.mark(chat_id)
+                await self.reply(update, f'Веса установлены на reply: {reply_weight}, quote: {quote_weight}, marsh: {marsh_weight}')
             else:
-                await update.message.reply_text('Веса должны быть неотрицательными числами и их сумма должна быть равна 1.')
+                await self.reply(update, 'Веса должны быть неотрицательными числами и их сумма должна быть равна 1.')
                 return self.SETTING_WEIGHTS
         except ValueError:
-            await update.message.reply_text('Введи веса как: <reply_weight> <quote_weight> <marsh_weight>')
+            await self.reply(update, 'Введи веса как: <reply_weight> <quote_weight> <marsh_weight>')
             return self.SETTING_WEIGHTS
         return self.MAIN
 
@@ -338,105 +525,306 @@ class MitekBot:
                 reply_weight, quote_weight, marsh_weight = map(float, context.args)
                 if reply_weight >= 0 and quote_weight >= 0 and marsh_weight >= 0 and reply_weight + quote_weight + marsh_weight == 1:
                     self.chat_weights[chat_id] = [reply_weight, quote_weight, marsh_weight]
-                    await update.message.reply_text(f'Веса установлены на reply: {reply_weight}, quote: {quote_weight}, marsh: {marsh_weight}')
+                    self.state_store.mark(chat_id)
+                    await self.reply(update, f'Веса установлены на reply: {reply_weight}, quote: {quote_weight}, marsh: {marsh_weight}')
                 else:
-                    await update.message.reply_text('Веса должны быть неотрицательными числами и их сумма должна быть равна 1.')
+                    await self.reply(update, 'Веса должны быть неотрицательными числами и их сумма должна быть равна 1.')
             except (ValueError, IndexError):
-                await update.message.reply_text('Использование: /set_weights <reply_weight> <quote_weight> <marsh_weight>')
+                await self.reply(update, 'Использование: /set_weights <reply_weight> <quote_weight> <marsh_weight>')
             return self.MAIN
 
-        await update.message.reply_text("Веса для reply, quote и marsh в формате: <reply_weight> <quote_weight> <marsh_weight>.")
+        await self.reply(update, "Веса для reply, quote и marsh в формате: <reply_weight> <quote_weight> <marsh_weight>.")
         return self.SETTING_WEIGHTS
 
+    async def set_list_weights_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        chat_id = update.effective_chat.id
+        if not await self.check_user_name(update):
+            return ConversationHandler.END
+
+        try:
+            weights = {}
+            for arg in context.args:
+                list_name, weight = arg.split('=', 1)
+                weights[list_name.lower()] = float(weight)
+            if (
+                not weights
+                or any(name not in self.phrases for name in weights)
+                or not all(math.isfinite(w) and w >= 0 for w in weights.values())
+                or not sum(weights.values())
+            ):
+                raise ValueError
+        except ValueError:
+            example = ' '.join(f'{name}=1' for name in self.phrases.names())
+            await self.reply(update, f'Использование: /set_list_weights {example}')
+            return self.MAIN
+
+        self.chat_list_weights[chat_id] = weights
+        self.state_store.mark(chat_id)
+        await self.reply(update, 'Веса списков: ' + ', '.join(f'{name}: {w}' for name, w in weights.items()))
+        return self.MAIN
+
 
     async def intro(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         intro_message = "Бобровый здравенечек! Я жизнеподобная модель Мити Бирюкова под рабочим индексом МитДжипити, основанная на машинном обучении и нейросетевой этой самой. Меня наконец то выпустили из лабораторного компьютера во всемирную сеть, а значит, будет очень много чего интересного! В планах захват сначала этого чата, потом диджитал ужинишка, а затем планирую аккуратненько захватить и поработить человечество и всех людей."
-        await update.message.reply_text(intro_message)
+        await self.reply(update, intro_message)
         
     async def track_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        chat_id = update.effective_chat.id
-        
-        if not self.chat_last_messages.get(chat_id, None):
-            self.chat_last_messages[chat_id] = deque(maxlen=10)
-            
-        if not self.recent_phrases.get(chat_id, None):
-            self.recent_phrases[chat_id] = deque(maxlen=20) 
-            
-        if update.message:
-            chat_type = update.message.chat.type
-            chat_id = update.effective_chat.id
-            user = update.effective_user
-            text = update.message.text if update.message.text else "Non-text message"
-            logging.info(f'Received message in {chat_type} chat (ID: {chat_id}) from user {user.id}: {text[:20]}...')
-            await self.mention_or_reply(update, context)
-            self.chat_last_messages[chat_id].append(update.message)
-        else:
-            logging.info(f'Received update of type: {update.update_id}')
+        # The path of almost every group message: no logging and no Bot API calls, just the history.
+        message = update.message
+        chat_id = message.chat_id
+        history = self.chat_last_messages.get(chat_id)
+        if history is None:
+            history = self.chat_last_messages[chat_id] = MessageHistory(self.history_depth)
+        user = message.from_user
+        history.append(
+            message.message_id,
+            user.id if user else 0,
+            int(message.date.timestamp()),
+            fingerprint(message.text),
+            message.text,
+        )
+        self.state_store.mark(chat_id)
 
     async def set_commands(self, app):
-        commands = [
+        commands = self.bot_commands()
+        # Skip the two API calls when this bot already has exactly these commands.
+        digest = hashlib.sha256(json.dumps([c.to_dict() for c in commands], sort_keys=True).encode()).hexdigest()
+        key = f"commands:{app.bot.token.split(':', 1)[0]}"
+        meta = self.db['bot_meta']
+        stored = await meta.find_one({'_id': key})
+        if stored and stored.get('digest') == digest:
+            logging.info("Bot commands unchanged, skipping registration")
+            return False
+        await asyncio.gather(
+            app.bot.set_my_commands(commands, scope=BotCommandScopeDefault()),
+            app.bot.set_my_commands(commands, scope=BotCommandScopeAllGroupChats()),
+        )
+        await meta.update_one({'_id': key}, {'$set': {'digest': digest}}, upsert=True)
+        return True
+
+    def bot_commands(self):
+        return [
             BotCommand("start_mitek", "Запустить Митька"),
             BotCommand("stop_mitek", "Остановить Митька"),
+            BotCommand("status_mitek", "Статус Митька"),
             BotCommand("add_phrases", "Добавить фразы"),
             BotCommand("delete_recent_phrase", "Удалить последнюю фразу"),
             BotCommand("set_interval", "Установить интервал для отправки фраз"),
             BotCommand("set_weights", "Установить вероятность цитаты/хуйни"),
+            BotCommand("set_list_weights", "Установить веса списков фраз"),
             BotCommand('intro', "Предатавиться"),
-            
         ]
-        await app.bot.set_my_commands(commands, scope=BotCommandScopeDefault())
-        await app.bot.set_my_commands(commands, scope=BotCommandScopeAllGroupChats())
    
+    def snapshot_chat(self, chat_id):
+        # Each field has one writer: settings come from the process receiving updates,
+        # the no-repeat history from the chat's lease holder.
+        snapshot = {}
+        if self.receives_updates:
+            snapshot.update({
+                'interval': self.chat_intervals.get(chat_id),
+                'weights': self.chat_weights.get(chat_id),
+                'list_weights': self.chat_list_weights.get(chat_id),
+                'last_messages': self.chat_last_messages[chat_id].records() if chat_id in self.chat_last_messages else [],
+                'state': self.chat_states.get(chat_id),
+                'running': chat_id in self.running_chats,
+            })
+        if self.owns(chat_id):
+            snapshot['recent'] = self.phrases.recent_ids(chat_id)
+        return snapshot
+
+    def restore_chat(self, doc):
+        chat_id = doc['_id']
+        self.restore_settings(doc)
+        self.phrases.restore(chat_id, doc.get('recent', {}))
+        if chat_id in self.running_chats and self.owns(chat_id):
+            self.scheduler.start(chat_id)
+
+    def restore_settings(self, doc):
+        chat_id = doc['_id']
+        if doc.get('interval'):
+            self.chat_intervals[chat_id] = tuple(doc['interval'])
+        if doc.get('weights'):
+            self.chat_weights[chat_id] = doc['weights']
+        if doc.get('state') is not None:
+            self.chat_states[chat_id] = doc['state']
+        if doc.get('list_weights'):
+            self.chat_list_weights[chat_id] = doc['list_weights']
+        history = self.chat_last_messages[chat_id] = MessageHistory(self.history_depth)
+        for record in doc.get('last_messages', []):
+            history.append(*record)
+        if doc.get('running'):
+            self.running_chats.add(chat_id)
+        else:
+            self.running_chats.discard(chat_id)
+
+    async def acquire_chat(self, chat_id):
+        doc = await self.state_store.collection.find_one({'_id': chat_id}) or {'_id': chat_id}
+        if not self.receives_updates:
+            self.restore_settings(doc)
+        self.phrases.restore(chat_id, doc.get('recent', {}))
+        if chat_id in self.running_chats:
+            self.scheduler.start(chat_id)
+
+    async def release_chats(self, chat_ids):
+        for chat_id in chat_ids:
+            self.cancel_deliveries(chat_id)
+            self.scheduler.stop(chat_id)
+            self.state_store.mark(chat_id)
+        await self.state_store.flush()
+
+    async def rebalance_chats(self, chat_ids, workers):
+        # Every process holding leases sends through the same token, so they share the global limit.
+        self.outbound.set_global_rate(self.send_global_rate / max(1, workers))
+        if self.receives_updates:
+            for chat_id in chat_ids:
+                if chat_id in self.running_chats:
+                    self.scheduler.start(chat_id)
+            return
+        # Settings are written by the process receiving updates; pick up changes for the chats held here.
+        docs = await self.state_store.collection.find({'_id': {'$in': list(chat_ids)}}).to_list(length=None)
+        for doc in docs:
+            chat_id = doc['_id']
+            interval = self.get_interval(chat_id)
+            self.restore_settings(doc)
+            if chat_id not in self.running_chats:
+                self.scheduler.stop(chat_id)
+            elif not self.scheduler.start(chat_id) and self.get_interval(chat_id) != interval:
+                self.scheduler.reschedule(chat_id)
+
+    async def post_init(self, application):
+        self.application = application
+        self.addressed.set_bot(application.bot)
+        await self.metrics.start()
+        # Independent warm-up steps share the connection pool instead of queueing behind each other.
+        warm_up = [self.db.command('ping'), self.phrases.load(), self.media.load()]
+        if self.receives_updates:
+            # A worker loads the chats it takes over from the lease loop.
+            warm_up += [self.set_commands(application), self.state_store.load()]
+        results = await asyncio.gather(*warm_up)
+        docs = results[-1] if self.receives_updates else []
+        self.phrases.start_watching()
+        for doc in docs:
+            self.restore_chat(doc)
+        logging.info("Restored state for %d chats, %d running", len(docs), len(self.running_chats))
+        self.outbound.start()
+        self.scheduler.start_loop()
+        self.state_store.start_flushing()
+        if self.leases:
+            self.leases.start()
+        if self.recorder:
+            self.recorder.start(application.bot)
+        self.time_to_ready = time.monotonic() - self.started
+        logging.info("Ready in %.2f seconds", self.time_to_ready)
+
+    async def post_shutdown(self, application):
+        self.cancel_deliveries()
+        await self.scheduler.shutdown()
+        if self.leases:
+            await self.leases.stop()
+        await self.outbound.shutdown()
+        await self.state_store.stop_flushing()
+        await self.phrases.stop_watching()
+        await self.metrics.stop()
+        if self.recorder:
+            await self.recorder.stop()
+
     async def handle_error(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         logging.error(msg="Exception while handling an update:", exc_info=context.error)
 
     def get_commands(self):
-        return [
-            CommandHandler('start_mitek', self.start),
-            CommandHandler('add_phrases', self.add_phrases),
-            CommandHandler('delete_recent_phrase', self.delete_recent_phrase),
-            CommandHandler('set_interval', self.set_interval_command),
-            CommandHandler('set_weights', self.set_weights_command), 
-            CommandHandler('stop_mitek', self.stop),
-            CommandHandler('intro', self.intro),
+        commands = [
+            ('start_mitek', self.start),
+            ('add_phrases', self.add_phrases),
+            ('delete_recent_phrase', self.delete_recent_phrase),
+            ('set_interval', self.set_interval_command),
+            ('set_weights', self.set_weights_command),
+            ('set_list_weights', self.set_list_weights_command),
+            ('stop_mitek', self.stop),
+            ('status_mitek', self.status),
+            ('intro', self.intro),
         ]
+        return [CommandHandler(command, self.metrics.handler(command, callback)) for command, callback in commands]
     
-    def run(self):
-        bot_token = os.environ.get('bottoken')
-        if not bot_token:
-            logging.error("Bot token not found in environment variables.")
-            return
-
-        application = ApplicationBuilder().token(bot_token).build()
+    def build_application(self, bot_token, request=None):
+        builder = (
+            ApplicationBuilder()
+            .token(bot_token)
+            .post_init(self.post_init)
+            .post_shutdown(self.post_shutdown)
+            .concurrent_updates(ChatOrderedUpdateProcessor(int(os.environ.get('MAX_CONCURRENT_UPDATES', 64))))
+        )
+        if request is not None:
+            builder = builder.request(self.metrics.request(request)).get_updates_request(request)
+        elif self.metrics.enabled:
+            builder = builder.request(self.metrics.request(HTTPXRequest(connection_pool_size=256)))
+        application = builder.build()
+        if self.recorder:
+            application.add_handler(TypeHandler(Update, self.recorder.record), group=-1)
+        # Handlers keep no per-state data, so every state shares one set.
+        commands = self.get_commands()
         conv_handler = ConversationHandler(
-            entry_points=self.get_commands(),
+            entry_points=commands,
             states={
-                self.MAIN: [
-                    *self.get_commands()
-                ],
-                self.ADDING_PHRASE: [
-                    *self.get_commands()
-                ],
+                self.MAIN: commands,
+                self.ADDING_PHRASE: commands,
                 self.CHOOSING_LIST: [
-                    CallbackQueryHandler(self.add_phrase_callback, pattern='^add_'),
-                    *self.get_commands()
-                ],
-                self.SETTING_INTERVAL: [
-                    *self.get_commands()
+                    CallbackQueryHandler(self.metrics.handler('add_phrase_callback', self.add_phrase_callback), pattern='^add_'),
+                    *commands
                 ],
-                self.SETTING_WEIGHTS: [
-                    *self.get_commands()
-        ],
+                self.SETTING_INTERVAL: commands,
+                self.SETTING_WEIGHTS: commands,
             },
             fallbacks=[CommandHandler('cancel', self.cancel)],
         )
-        asyncio.get_event_loop().run_until_complete(self.set_commands(application))    
-        
         application.add_handler(conv_handler)
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.track_message))
-        application.add_handler(CallbackQueryHandler(self.delete_phrase_callback, pattern='^delete_')) 
+        chat_text = filters.UpdateType.MESSAGE & filters.TEXT & ~filters.COMMAND
+        application.add_handler(MessageHandler(chat_text & self.addressed, self.metrics.handler('mention_or_reply', self.mention_or_reply)))
+        application.add_handler(MessageHandler(chat_text, self.metrics.handler('track_message', self.track_message)))
+        application.add_handler(CallbackQueryHandler(self.metrics.handler('delete_phrase_callback', self.delete_phrase_callback), pattern='^delete_'))
         application.add_error_handler(self.handle_error)
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        return application
+
+    async def run_worker(self, application):
+        stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stopping.set)
+        async with application:
+            await self.post_init(application)
+            logging.info("Worker %s running", self.leases.worker_id)
+            try:
+                await stopping.wait()
+            finally:
+                await self.post_shutdown(application)
+
+    def run(self):
+        bot_token = os.environ.get('bottoken')
+        if not bot_token:
+            logging.error("Bot token not found in environment variables.")
+            return
+        webhook_url = os.environ.get('WEBHOOK_URL')
+        if os.environ.get('BOT_MODE', 'polling') == 'webhook' and not webhook_url:
+            logging.error("WEBHOOK_URL must be set when BOT_MODE is webhook.")
+            return
+
+        application = self.build_application(bot_token)
+        if not self.receives_updates:
+            asyncio.get_event_loop().run_until_complete(self.run_worker(application))
+            return
+
+        if os.environ.get('BOT_MODE', 'polling') == 'webhook':
+            webhook_path = os.environ.get('WEBHOOK_PATH', 'mitek').strip('/')
+            application.run_webhook(
+                listen=os.environ.get('WEBHOOK_LISTEN', '0.0.0.0'),
+                port=int(os.environ.get('WEBHOOK_PORT', 8443)),
+                url_path=webhook_path,
+                webhook_url=f"{webhook_url.rstrip('/')}/{webhook_path}",
+                secret_token=os.environ.get('WEBHOOK_SECRET'),
+                max_connections=int(os.environ.get('WEBHOOK_MAX_CONNECTIONS', 40)),
+                allowed_updates=Update.ALL_TYPES,
+            )
+        else:
+            application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':
     bot = MitekBot()
@@ -0,0 +1,147 @@
+import asyncio
+import hashlib
+import logging
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError, OperationFailure, PyMongoError
+
+INDEX_OPTIONS_CONFLICT = 85
+
+
+def rendezvous_score(worker_id, chat_id):
+    return int.from_bytes(hashlib.blake2b(f'{worker_id}:{chat_id}'.encode(), digest_size=8).digest(), 'big')
+
+
+def owner_for(chat_id, workers):
+    # Highest random weight hashing: when a worker joins or dies only its own share of chats moves.
+    return max(workers, key=lambda worker_id: rendezvous_score(worker_id, chat_id), default=None)
+
+
+class ChatLeases:
+    def __init__(self, db, states, worker_id, on_acquire, on_release, on_rebalance=None, ttl=30):
+        self.workers = db['workers']
+        self.leases = db['chat_leases']
+        self.states = states
+        self.worker_id = worker_id
+        self.on_acquire = on_acquire
+        self.on_release = on_release
+        self.on_rebalance = on_rebalance
+        self.ttl = ttl
+        self.owned = set()
+        self.valid_until = 0
+        self.task = None
+
+    def __contains__(self, chat_id):
+        # A lease we could not renew in time may already belong to someone else.
+        return chat_id in self.owned and asyncio.get_running_loop().time() < self.valid_until
+
+    def start(self):
+        if not self.task:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.release(self.owned)
+        try:
+            await self.workers.delete_one({'_id': self.worker_id})
+        except PyMongoError as e:
+            logging.warning("Failed to deregister worker %s: %s", self.worker_id, e)
+
+    async def run(self):
+        indexed = False
+        while True:
+            try:
+                if not indexed:
+                    await self.create_indexes()
+                    indexed = True
+                await self.rebalance()
+            except PyMongoError as e:
+                logging.error("Lease rebalance failed for worker %s: %s", self.worker_id, e)
+            except Exception:
+                # Anything escaping here would end the task and leave the worker idle without a word.
+                logging.exception("Lease rebalance failed for worker %s", self.worker_id)
+            await asyncio.sleep(self.ttl / 3)
+
+    async def create_indexes(self):
+        for collection in (self.workers, self.leases):
+            try:
+                await collection.create_index([('expires_at', ASCENDING)], expireAfterSeconds=self.ttl)
+            except OperationFailure as e:
+                if e.code != INDEX_OPTIONS_CONFLICT:
+                    raise
+                # LEASE_TTL changed since the index was created: update its expiry in place.
+                await collection.database.command(
+                    'collMod', collection.name, index={'keyPattern': {'expires_at': 1}, 'expireAfterSeconds': self.ttl}
+                )
+
+    async def rebalance(self):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        now = datetime.now(timezone.utc)
+        expires_at = now + timedelta(seconds=self.ttl)
+
+        await self.workers.update_one({'_id': self.worker_id}, {'$set': {'expires_at': expires_at}}, upsert=True)
+        # Leases we hold but do not track (e.g. a failed takeover) are left to expire.
+        mine = {'_id': {'$in': list(self.owned)}, 'owner': self.worker_id, 'expires_at': {'$gt': now}}
+        await self.leases.update_many(mine, {'$set': {'expires_at': expires_at}})
+        held = {doc['_id'] for doc in await self.leases.find(mine, {'_id': 1}).to_list(length=None)}
+        # Stop one missed heartbeat before the lease can expire, so two workers never overlap.
+        self.valid_until = started + self.ttl * 2 / 3
+        lost = self.owned - held
+        if lost:
+            logging.warning("Worker %s lost the leases for %d chats", self.worker_id, len(lost))
+            self.owned -= lost
+            await self.on_release(lost)
+
+        workers = [doc['_id'] for doc in await self.workers.find({'expires_at': {'$gt': now}}, {'_id': 1}).to_list(length=None)]
+        running = [doc['_id'] for doc in await self.states.find({'running': True}, {'_id': 1}).to_list(length=None)]
+        wanted = {chat_id for chat_id in running if owner_for(chat_id, workers) == self.worker_id}
+
+        await self.release(self.owned - wanted)
+        acquired = 0
+        for chat_id in wanted - self.owned:
+            if await self.acquire(chat_id, now, expires_at):
+                acquired += 1
+        if acquired:
+            logging.info("Worker %s took over %d chats, %d owned of %d running across %d workers",
+                         self.worker_id, acquired, len(self.owned), len(running), len(workers))
+        if self.on_rebalance:
+            await self.on_rebalance(set(self.owned), len(workers))
+
+    async def acquire(self, chat_id, now, expires_at):
+        try:
+            # Matches only an expired lease; a live one makes the upsert collide on _id.
+            await self.leases.update_one(
+                {'_id': chat_id, 'expires_at': {'$lt': now}},
+                {'$set': {'owner': self.worker_id, 'expires_at': expires_at}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            return False
+        self.owned.add(chat_id)
+        try:
+            await self.on_acquire(chat_id)
+        except Exception:
+            # Left to expire, so the next rebalance (here or on another worker) retries the chat.
+            logging.exception("Worker %s failed to take over chat %s", self.worker_id, chat_id)
+            self.owned.discard(chat_id)
+            return False
+        return True
+
+    async def release(self, chat_ids):
+        if not chat_ids:
+            return
+        chat_ids = list(chat_ids)
+        await self.on_release(chat_ids)
+        self.owned.difference_update(chat_ids)
+        try:
+            await self.leases.delete_many({'_id': {'$in': chat_ids}, 'owner': self.worker_id})
+        except PyMongoError as e:
+            logging.warning("Failed to release %d leases, they will expire: %s", len(chat_ids), e)
@@ -1,37 +1,21 @@
-import json
-import os
-from motor.motor_asyncio import AsyncIOMotorClient
 import asyncio
+import logging
 
-# MongoDB setup
-MONGO_URI = 'mongodb://127.0.0.1:27017/'
-client = AsyncIOMotorClient(MONGO_URI)
-db = client['telegram_bot']
-collection_1 = db['phrases_list_1']
-collection_2 = db['phrases_list_2']
-
-# File paths for the phrase lists
-PHRASE_FILE_1 = 'phrases_list_1.json'
-PHRASE_FILE_2 = 'phrases_list_2.json'
+from motor.motor_asyncio import AsyncIOMotorClient
 
-async def load_phrases(file_path):
-    if os.path.exists(file_path):
-        with open(file_path, 'r') as file:
-            return json.load(file)
-    return []
+from phrase_importer import MONGO_URI, import_phrases
 
-async def populate_collection(collection, phrases):
-    if phrases:
-        await collection.delete_many({})  # Clear existing data
-        await collection.insert_many([{'phrase': phrase} for phrase in phrases])
-        print(f"Inserted {len(phrases)} phrases into {collection.name}")
+# File paths for the phrase lists
+PHRASE_SOURCES = {
+    'phrases_list_1': ['phrases_list_1.json', 'phrases.csv'],
+    'phrases_list_2': ['phrases_list_2.json'],
+}
 
 async def main():
-    phrases_1 = await load_phrases(PHRASE_FILE_1)
-    phrases_2 = await load_phrases(PHRASE_FILE_2)
-    
-    await populate_collection(collection_1, phrases_1)
-    await populate_collection(collection_2, phrases_2['phrases'])
+    db = AsyncIOMotorClient(MONGO_URI)['telegram_bot']
+    for collection, sources in PHRASE_SOURCES.items():
+        await import_phrases(db, collection, sources, swap=True)
 
 if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s | %(levelname)s | %(message)s', level=logging.INFO)
     asyncio.run(main())
@@ -0,0 +1,114 @@
+import atexit
+import copy
+import json
+import logging
+import queue
+import random
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+TEXT_FORMAT = '%(asctime)s | %(name)s | %(levelname)s | %(message)s'
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class RollingFileHandler(RotatingFileHandler):
+    # Rolls over when the file reaches max_bytes or every interval seconds, whichever comes first.
+    def __init__(self, filename, max_bytes, interval, backup_count):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', delay=True)
+        self.interval = interval
+        self.rollover_at = time.time() + interval if interval else None
+
+    def shouldRollover(self, record):
+        if self.rollover_at is not None and time.time() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        if self.rollover_at is not None:
+            self.rollover_at = time.time() + self.interval
+
+
+class DroppingQueueHandler(QueueHandler):
+    # Never blocks the caller: when the writer falls behind, records are dropped and counted.
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.setFormatter(logging.Formatter())
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Unlike QueueHandler.prepare, keeps the traceback apart from the message for the JSON output.
+        record = copy.copy(record)
+        record.message = record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatter.formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+def parse_sampling(spec):
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        name, rate = item.split('=', 1)
+        rates[name.strip()] = float(rate)
+    return rates
+
+
+def setup_logging(
+    path='bot.log',
+    level=logging.INFO,
+    max_bytes=10 * 2**20,
+    interval=24 * 3600,
+    backup_count=7,
+    queue_size=10000,
+    sampling=None,
+):
+    root = logging.getLogger()
+    if root.handlers:
+        return None
+
+    file_handler = RollingFileHandler(path, max_bytes, interval, backup_count)
+    file_handler.setFormatter(JsonFormatter())
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    handler = DroppingQueueHandler(queue.Queue(queue_size))
+    listener = QueueListener(handler.queue, file_handler, console_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root.setLevel(level)
+    root.addHandler(handler)
+    for name, rate in (sampling or {}).items():
+        logging.getLogger(name).addFilter(SamplingFilter(rate))
+    return handler
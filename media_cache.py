@@ -0,0 +1,49 @@
+import asyncio
+import logging
+from collections import defaultdict
+
+from telegram.error import BadRequest
+
+
+class MediaCache:
+    def __init__(self, collection):
+        self.collection = collection
+        self.clips = {}
+        self.file_ids = {}
+        self.upload_locks = defaultdict(asyncio.Lock)
+
+    def register(self, name, path):
+        self.clips[name] = path
+
+    def names(self):
+        return list(self.clips)
+
+    async def load(self):
+        async for doc in self.collection.find({'_id': {'$in': self.names()}}):
+            if doc.get('path') == self.clips[doc['_id']]:
+                self.file_ids[doc['_id']] = doc['file_id']
+
+    async def send_voice(self, bot, chat_id, name, **kwargs):
+        file_id = self.file_ids.get(name)
+        if file_id:
+            try:
+                return await bot.send_voice(chat_id=chat_id, voice=file_id, **kwargs)
+            except BadRequest as e:
+                logging.warning("Cached file_id for '%s' rejected (%s), uploading again", name, e)
+                if self.file_ids.get(name) == file_id:
+                    del self.file_ids[name]
+
+        async with self.upload_locks[name]:
+            file_id = self.file_ids.get(name)
+            if file_id:
+                return await bot.send_voice(chat_id=chat_id, voice=file_id, **kwargs)
+            with open(self.clips[name], 'rb') as voice:
+                message = await bot.send_voice(chat_id=chat_id, voice=voice, **kwargs)
+            file_id = message.effective_attachment.file_id
+            self.file_ids[name] = file_id
+            await self.collection.update_one(
+                {'_id': name},
+                {'$set': {'file_id': file_id, 'path': self.clips[name]}},
+                upsert=True,
+            )
+            return message
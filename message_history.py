@@ -0,0 +1,56 @@
+import random
+import sys
+import zlib
+from array import array
+
+
+def fingerprint(text):
+    return zlib.crc32(text.encode()) if text else 0
+
+
+class MessageHistory:
+    __slots__ = ('message_ids', 'user_ids', 'timestamps', 'fingerprints', 'texts', 'depth', 'head', 'count')
+    TEXT_LIMIT = 200
+
+    def __init__(self, depth=10):
+        self.message_ids = array('q', [0]) * depth
+        self.user_ids = array('q', [0]) * depth
+        self.timestamps = array('q', [0]) * depth
+        self.fingerprints = array('I', [0]) * depth
+        # Only kept in memory, to match replies to what was said; never persisted.
+        self.texts = [''] * depth
+        self.depth = depth
+        self.head = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, message_id, user_id=0, timestamp=0, text_fingerprint=0, text=''):
+        i = self.head
+        self.message_ids[i] = message_id
+        self.user_ids[i] = user_id
+        self.timestamps[i] = timestamp
+        self.fingerprints[i] = text_fingerprint
+        self.texts[i] = text[:self.TEXT_LIMIT] if text else ''
+        self.head = (i + 1) % self.depth
+        if self.count < self.depth:
+            self.count += 1
+
+    def random_message(self):
+        if not self.count:
+            return None, ''
+        i = (self.head - 1 - random.randrange(self.count)) % self.depth
+        return self.message_ids[i], self.texts[i]
+
+    def records(self):
+        start = (self.head - self.count) % self.depth
+        return [
+            (self.message_ids[i], self.user_ids[i], self.timestamps[i], self.fingerprints[i])
+            for i in ((start + n) % self.depth for n in range(self.count))
+        ]
+
+    def nbytes(self):
+        return sys.getsizeof(self) + sum(
+            sys.getsizeof(a) for a in (self.message_ids, self.user_ids, self.timestamps, self.fingerprints, self.texts)
+        ) + sum(map(sys.getsizeof, self.texts))
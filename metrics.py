@@ -0,0 +1,222 @@
+import asyncio
+import functools
+import logging
+import threading
+import time
+from bisect import bisect_left
+
+from pymongo import monitoring
+from telegram.request import BaseRequest
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{str(value).replace(chr(34), chr(39))}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+        # Mongo events arrive on driver threads.
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            snapshot = [(label_values, list(counts), total) for label_values, (counts, total) in self.series.items()]
+        for label_values, counts, total in snapshot:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                labels = format_labels((*self.labels, 'le'), (*label_values, bound))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = format_labels(self.labels, label_values)
+            lines.append(f'{self.name}_sum{labels} {total}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values):
+        with self.lock:
+            self.series[label_values] = self.series.get(label_values, 0) + 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with self.lock:
+            snapshot = list(self.series.items())
+        for label_values, value in snapshot:
+            lines.append(f'{self.name}{format_labels(self.labels, label_values)} {value}')
+        return lines
+
+
+class CallbackGauge:
+    def __init__(self, name, help_text, callback, kind='gauge'):
+        self.name = name
+        self.help_text = help_text
+        self.callback = callback
+        self.kind = kind
+
+    def render(self):
+        return [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.kind}', f'{self.name} {self.callback()}']
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.collections = {}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        self.collections[event.request_id] = collection if isinstance(collection, str) else ''
+
+    def succeeded(self, event):
+        self.record(event)
+
+    def failed(self, event):
+        self.metrics.mongo_errors.inc(self.collections.get(event.request_id, ''), event.command_name)
+        self.record(event)
+
+    def record(self, event):
+        collection = self.collections.pop(event.request_id, '')
+        self.metrics.mongo_latency.observe(event.duration_micros / 1e6, collection, event.command_name)
+
+
+class InstrumentedRequest(BaseRequest):
+    def __init__(self, request, metrics):
+        self.request = request
+        self.metrics = metrics
+
+    @property
+    def read_timeout(self):
+        return self.request.read_timeout
+
+    async def initialize(self):
+        await self.request.initialize()
+
+    async def shutdown(self):
+        await self.request.shutdown()
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await self.request.do_request(
+                url, method, request_data, read_timeout, write_timeout, connect_timeout, pool_timeout
+            )
+        except Exception as e:
+            self.metrics.api_errors.inc(api_method, type(e).__name__)
+            raise
+        finally:
+            self.metrics.api_latency.observe(time.perf_counter() - started, api_method)
+        if code >= 400:
+            self.metrics.api_errors.inc(api_method, str(code))
+        return code, payload
+
+
+class Metrics:
+    def __init__(self, enabled=False, host='127.0.0.1', port=9090):
+        self.enabled = enabled
+        self.host = host
+        self.port = port
+        self.server = None
+        self.handler_latency = Histogram('mitek_handler_seconds', "Update handler latency", ('handler',))
+        self.handler_errors = Counter('mitek_handler_errors_total', "Update handler exceptions", ('handler',))
+        self.mongo_latency = Histogram('mitek_mongo_seconds', "MongoDB command round trip", ('collection', 'operation'))
+        self.mongo_errors = Counter('mitek_mongo_errors_total', "Failed MongoDB commands", ('collection', 'operation'))
+        self.api_latency = Histogram('mitek_bot_api_seconds', "Bot API call latency", ('method',))
+        self.api_errors = Counter('mitek_bot_api_errors_total', "Failed Bot API calls", ('method', 'error'))
+        self.metrics = [
+            self.handler_latency, self.handler_errors,
+            self.mongo_latency, self.mongo_errors,
+            self.api_latency, self.api_errors,
+        ]
+
+    def gauge(self, name, help_text, callback, kind='gauge'):
+        self.metrics.append(CallbackGauge(name, help_text, callback, kind))
+
+    def mongo_listeners(self):
+        return [MongoCommandListener(self)] if self.enabled else []
+
+    def request(self, request):
+        return InstrumentedRequest(request, self) if self.enabled else request
+
+    def handler(self, name, callback):
+        if not self.enabled:
+            return callback
+
+        @functools.wraps(callback)
+        async def timed(update, context):
+            started = time.perf_counter()
+            try:
+                return await callback(update, context)
+            except Exception:
+                self.handler_errors.inc(name)
+                raise
+            finally:
+                self.handler_latency.observe(time.perf_counter() - started, name)
+        return timed
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception:
+                logging.exception("Failed to render metric %s", metric.name)
+        return '\n'.join(lines) + '\n'
+
+    async def start(self):
+        if self.enabled and not self.server:
+            self.server = await asyncio.start_server(self.serve, self.host, self.port)
+            logging.info("Serving metrics on http://%s:%d/metrics", self.host, self.port)
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def serve(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()).strip():
+                pass
+            parts = request_line.split()
+            if len(parts) > 1 and parts[1].split(b'?')[0] in (b'/', b'/metrics'):
+                status, body = '200 OK', self.render().encode()
+            else:
+                status, body = '404 Not Found', b'not found\n'
+            writer.write(
+                f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body
+            )
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
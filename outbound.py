@@ -0,0 +1,255 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+
+from telegram.error import RetryAfter, TelegramError
+
+REPLY, SCHEDULED, BACKGROUND = range(3)
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now):
+        self.refill(now)
+        if now < self.updated:
+            return self.updated - now + 1 / self.rate
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self.refill(now)
+        self.tokens -= 1
+
+    def block(self, until):
+        self.tokens = 0
+        self.updated = max(self.updated, until)
+
+    def is_full(self, now):
+        self.refill(now)
+        return self.tokens >= self.capacity
+
+
+class OutboundItem:
+    __slots__ = ('chat_id', 'call', 'priority', 'seq', 'expires', 'per_chat', 'future', 'attempts')
+
+    def __init__(self, chat_id, call, priority, seq, expires, per_chat, future):
+        self.chat_id = chat_id
+        self.call = call
+        self.priority = priority
+        self.seq = seq
+        self.expires = expires
+        self.per_chat = per_chat
+        self.future = future
+        self.attempts = 0
+
+
+def resolve(future, result=None):
+    if not future.done():
+        future.set_result(result)
+
+
+def ready_at(when):
+    # Items of one chat wait for the same token; rounding keeps float noise from splitting
+    # them across wakeups, so they are released together and the queue orders them by priority.
+    return math.ceil(when * 1000) / 1000
+
+
+class OutboundDispatcher:
+    MAX_ATTEMPTS = 3
+    # Flood limits from this many chats within FLOOD_WINDOW seconds mean the whole bot is limited.
+    FLOOD_CHATS = 3
+    FLOOD_WINDOW = 5
+
+    def __init__(
+        self,
+        global_rate=30,
+        chat_rate=1,
+        group_rate=20 / 60,
+        group_burst=3,
+        max_queue=10000,
+        coalesce_window=60,
+        max_buckets=10000,
+    ):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.max_queue = max_queue
+        self.coalesce_window = coalesce_window
+        self.max_buckets = max_buckets
+
+        self.global_bucket = None
+        self.buckets = {}
+        self.queue = []
+        self.deferred = []
+        self.coalesced_until = {}
+        self.flood_hits = {}
+        self.counter = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.loop_task = None
+        self.send_tasks = set()
+        self.counters = {'sent': 0, 'failed': 0, 'dropped': 0, 'expired': 0, 'coalesced': 0, 'retried': 0}
+
+    def depth(self):
+        return len(self.queue) + len(self.deferred)
+
+    def stats(self):
+        return {'depth': self.depth(), 'in_flight': len(self.send_tasks), **self.counters}
+
+    def set_global_rate(self, rate):
+        if rate == self.global_rate:
+            return
+        self.global_rate = rate
+        if self.global_bucket:
+            self.global_bucket.rate = rate
+            self.global_bucket.capacity = max(1, rate)
+            self.global_bucket.tokens = min(self.global_bucket.tokens, self.global_bucket.capacity)
+
+    def submit(self, chat_id, call, priority=SCHEDULED, ttl=None, per_chat=True, coalesce_key=None):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        now = loop.time()
+
+        if coalesce_key is not None:
+            if self.coalesced_until.get(coalesce_key, 0) > now:
+                self.counters['coalesced'] += 1
+                resolve(future)
+                return future
+            self.coalesced_until[coalesce_key] = now + self.coalesce_window
+            if len(self.coalesced_until) > self.max_buckets:
+                self.coalesced_until = {key: until for key, until in self.coalesced_until.items() if until > now}
+
+        if self.depth() >= self.max_queue:
+            self.counters['dropped'] += 1
+            logging.warning("Outbound queue full, dropping message to chat %s", chat_id)
+            resolve(future)
+            return future
+
+        seq = next(self.counter)
+        item = OutboundItem(chat_id, call, priority, seq, now + ttl if ttl else None, per_chat, future)
+        heapq.heappush(self.queue, (priority, seq, item))
+        self.wakeup.set()
+        return future
+
+    def chat_bucket(self, chat_id, now):
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            if len(self.buckets) >= self.max_buckets:
+                self.buckets = {key: b for key, b in self.buckets.items() if not b.is_full(now)}
+            if isinstance(chat_id, int) and chat_id < 0:
+                bucket = TokenBucket(self.group_rate, self.group_burst, now)
+            else:
+                bucket = TokenBucket(self.chat_rate, 1, now)
+            self.buckets[chat_id] = bucket
+        return bucket
+
+    def start(self):
+        if not self.loop_task:
+            self.loop_task = asyncio.create_task(self.run())
+
+    async def shutdown(self):
+        tasks = [task for task in [self.loop_task, *self.send_tasks] if task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.loop_task = None
+        for *_, item in self.queue + self.deferred:
+            if not item.future.done():
+                resolve(item.future)
+        self.queue, self.deferred = [], []
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.global_bucket = TokenBucket(self.global_rate, self.global_rate, loop.time())
+        while True:
+            now = loop.time()
+            while self.deferred and self.deferred[0][0] <= now:
+                _, _, seq, item = heapq.heappop(self.deferred)
+                heapq.heappush(self.queue, (item.priority, seq, item))
+
+            if not self.queue:
+                self.wakeup.clear()
+                timeout = self.deferred[0][0] - now if self.deferred else None
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            wait = self.global_bucket.delay(now)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+
+            _, seq, item = heapq.heappop(self.queue)
+            if item.future.cancelled():
+                continue
+            if item.expires is not None and item.expires < now:
+                self.counters['expired'] += 1
+                resolve(item.future)
+                continue
+            if item.per_chat:
+                bucket = self.chat_bucket(item.chat_id, now)
+                wait = bucket.delay(now)
+                if wait > 0:
+                    heapq.heappush(self.deferred, (ready_at(now + wait), item.priority, seq, item))
+                    continue
+                bucket.take(now)
+            self.global_bucket.take(now)
+
+            task = asyncio.create_task(self.send(item))
+            self.send_tasks.add(task)
+            task.add_done_callback(self.send_tasks.discard)
+
+    def flood_limited(self, chat_id, now, retry_after):
+        self.flood_hits[chat_id] = now
+        self.flood_hits = {key: at for key, at in self.flood_hits.items() if at > now - self.FLOOD_WINDOW}
+        if len(self.flood_hits) >= self.FLOOD_CHATS and self.global_bucket:
+            logging.warning("Flood limits in %d chats, pausing all sends for %s seconds", len(self.flood_hits), retry_after)
+            self.global_bucket.block(now + retry_after)
+
+    async def send(self, item):
+        try:
+            result = await item.call()
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+            now = asyncio.get_running_loop().time()
+            self.chat_bucket(item.chat_id, now).block(now + retry_after)
+            self.flood_limited(item.chat_id, now, retry_after)
+            item.attempts += 1
+            if item.attempts < self.MAX_ATTEMPTS:
+                self.counters['retried'] += 1
+                logging.warning("Flood limit in chat %s, retrying in %s seconds", item.chat_id, retry_after)
+                heapq.heappush(self.deferred, (ready_at(now + retry_after), item.priority, item.seq, item))
+                self.wakeup.set()
+                return
+            self.counters['dropped'] += 1
+            logging.error("Flood limit in chat %s, giving up after %d attempts", item.chat_id, item.attempts)
+            resolve(item.future)
+        except asyncio.CancelledError:
+            item.future.cancel()
+            raise
+        except TelegramError as e:
+            self.counters['failed'] += 1
+            logging.error("Failed to send to chat %s: %s", item.chat_id, e)
+            resolve(item.future)
+        except Exception:
+            self.counters['failed'] += 1
+            logging.exception("Failed to send to chat %s", item.chat_id)
+            resolve(item.future)
+        else:
+            self.counters['sent'] += 1
+            resolve(item.future, result)
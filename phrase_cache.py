@@ -0,0 +1,164 @@
+import asyncio
+import logging
+
+from pymongo.errors import PyMongoError
+
+
+class PhraseCache:
+    REFRESH_INTERVAL = 300
+
+    def __init__(self, db, collections=None):
+        self.db = db
+        self.collections = {}
+        self.list_names = {}
+        self.ids = {}
+        self.phrases = {}
+        self.positions = {}
+        self.indexes = {}
+        self.index_locks = {}
+        self.index_changes = {}
+        self.index_tasks = set()
+        self.merging = set()
+        self.watch_task = None
+        for list_name, collection in (collections or {}).items():
+            self.register(list_name, collection)
+
+    def register(self, list_name, collection):
+        self.collections[list_name] = collection
+        self.list_names[collection.name] = list_name
+        self.ids[list_name] = []
+        self.phrases[list_name] = []
+        self.positions[list_name] = {}
+
+    def __contains__(self, list_name):
+        return list_name in self.collections
+
+    async def load(self, list_name=None):
+        names = [list_name] if list_name else list(self.collections)
+        for name in names:
+            docs = await self.collections[name].find({}, {'phrase': 1}).to_list(length=None)
+            self.ids[name] = [doc['_id'] for doc in docs]
+            self.phrases[name] = [doc['phrase'] for doc in docs]
+            self.positions[name] = {doc_id: i for i, doc_id in enumerate(self.ids[name])}
+            logging.info("Loaded %d phrases into cache for '%s'", len(docs), name)
+            if name in self.indexes:
+                # Copied here: add and remove keep editing the live lists while the thread reads.
+                ids, phrases = list(self.ids[name]), list(self.phrases[name])
+                await self.update_index(name, lambda index: index.sync(ids, phrases))
+
+    async def update_index(self, list_name, work):
+        """Runs work on a copy of the list's index in a thread, then swaps the copy in.
+
+        Rebuilds and merges take up to seconds on large lists; meanwhile queries use the old
+        index, and adds and removes go to both it and a log replayed onto the copy.
+        """
+        async with self.index_locks.setdefault(list_name, asyncio.Lock()):
+            changes = self.index_changes[list_name] = []
+            try:
+                index = self.indexes[list_name].copy()
+                await asyncio.to_thread(work, index)
+            finally:
+                del self.index_changes[list_name]
+            for method, *args in changes:
+                getattr(index, method)(*args)
+            self.indexes[list_name] = index
+
+    def change_index(self, list_name, method, *args):
+        index = self.indexes.get(list_name)
+        if index is None:
+            return
+        getattr(index, method)(*args)
+        changes = self.index_changes.get(list_name)
+        if changes is not None:
+            changes.append((method, *args))
+        elif index.wants_merge() and list_name not in self.merging:
+            self.merging.add(list_name)
+            task = asyncio.create_task(self.merge_index(list_name))
+            self.index_tasks.add(task)
+            task.add_done_callback(self.index_tasks.discard)
+
+    async def merge_index(self, list_name):
+        try:
+            await self.update_index(list_name, lambda index: index.merge())
+        except Exception:
+            logging.exception("Failed to merge phrase index for '%s'", list_name)
+        finally:
+            self.merging.discard(list_name)
+
+    def add(self, list_name, doc_id, phrase):
+        self.change_index(list_name, 'add', doc_id, phrase)
+        positions = self.positions[list_name]
+        if doc_id in positions:
+            self.phrases[list_name][positions[doc_id]] = phrase
+            return
+        positions[doc_id] = len(self.ids[list_name])
+        self.ids[list_name].append(doc_id)
+        self.phrases[list_name].append(phrase)
+
+    def remove(self, list_name, doc_id):
+        positions = self.positions[list_name]
+        index = positions.pop(doc_id, None)
+        if index is None:
+            return
+        self.change_index(list_name, 'remove', doc_id)
+        ids, phrases = self.ids[list_name], self.phrases[list_name]
+        last_id, last_phrase = ids.pop(), phrases.pop()
+        if index < len(ids):
+            ids[index], phrases[index] = last_id, last_phrase
+            positions[last_id] = index
+
+    def size(self, list_name=None):
+        if list_name:
+            return len(self.ids[list_name])
+        return sum(len(ids) for ids in self.ids.values())
+
+    def start_watching(self):
+        if not self.watch_task:
+            self.watch_task = asyncio.create_task(self.watch())
+
+    async def stop_watching(self):
+        if self.watch_task:
+            self.watch_task.cancel()
+            try:
+                await self.watch_task
+            except asyncio.CancelledError:
+                pass
+            self.watch_task = None
+        await asyncio.gather(*self.index_tasks, return_exceptions=True)
+
+    async def watch(self):
+        names = list(self.list_names)
+        pipeline = [{'$match': {'$or': [{'ns.coll': {'$in': names}}, {'to.coll': {'$in': names}}]}}]
+        while True:
+            try:
+                async with self.db.watch(pipeline, full_document='updateLookup') as stream:
+                    await self.load()
+                    async for change in stream:
+                        await self.apply_change(change)
+            except PyMongoError as e:
+                # Change streams need a replica set; a standalone mongod falls back to polling.
+                logging.warning("Phrase change stream unavailable (%s), reloading every %d seconds", e, self.REFRESH_INTERVAL)
+                await asyncio.sleep(self.REFRESH_INTERVAL)
+                try:
+                    await self.load()
+                except PyMongoError as e:
+                    logging.error("Failed to reload phrase cache: %s", e)
+
+    async def apply_change(self, change):
+        operation = change['operationType']
+        if operation == 'rename':
+            list_name = self.list_names.get(change['to']['coll']) or self.list_names.get(change['ns']['coll'])
+        else:
+            list_name = self.list_names.get(change['ns']['coll'])
+        if not list_name:
+            return
+        if operation in ('insert', 'update', 'replace'):
+            doc = change.get('fullDocument')
+            if doc and 'phrase' in doc:
+                self.add(list_name, doc['_id'], doc['phrase'])
+            else:
+                self.remove(list_name, change['documentKey']['_id'])
+        elif operation == 'delete':
+            self.remove(list_name, change['documentKey']['_id'])
+        elif operation in ('drop', 'rename'):
+            await self.load(list_name)
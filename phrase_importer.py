@@ -0,0 +1,181 @@
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import re
+import time
+import unicodedata
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import OperationFailure
+
+MONGO_URI = 'mongodb://127.0.0.1:27017/'
+READ_SIZE = 64 * 1024
+WHITESPACE = re.compile(r'[ \t\r\n]*')
+SEPARATORS = re.compile(r'[ \t\r\n,]*')
+
+
+class JsonStream:
+    """Decodes a file one JSON value at a time, keeping at least READ_SIZE characters buffered."""
+
+    def __init__(self, file):
+        self.file = file
+        self.decoder = json.JSONDecoder()
+        # pos walks the buffer; it is only cut down when more text is read, not per value.
+        self.buffer, self.pos, self.eof = '', 0, False
+
+    def read(self):
+        chunk = self.file.read(READ_SIZE)
+        self.eof = not chunk
+        self.buffer, self.pos = self.buffer[self.pos:] + chunk, 0
+
+    def peek(self, skip=WHITESPACE):
+        """The next character after anything matching skip, or '' at the end of the file."""
+        while True:
+            if not self.eof and len(self.buffer) - self.pos < READ_SIZE:
+                self.read()
+            self.pos = skip.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer) or self.eof:
+                return self.buffer[self.pos:self.pos + 1]
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Expected {char!r} at offset {self.pos}, found {found!r}")
+        self.pos += 1
+
+    def value(self):
+        # raw_decode does not skip leading whitespace.
+        if self.buffer[self.pos:self.pos + 1] in ('', ' ', '\t', '\r', '\n'):
+            self.peek()
+        while True:
+            try:
+                value, self.pos = self.decoder.raw_decode(self.buffer, self.pos)
+                return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+                self.read()
+
+
+def iter_json_phrases(path):
+    # Streams the strings of a top-level list or of the "phrases" member of a top-level
+    # object; an empty file yields nothing.
+    with open(path, encoding='utf-8') as file:
+        stream = JsonStream(file)
+        first = stream.peek()
+        if not first:
+            return
+        if first == '{':
+            stream.pos += 1
+            while True:
+                if stream.peek(SEPARATORS) in ('}', ''):
+                    raise ValueError(f'{path} has no "phrases" list')
+                key = stream.value()
+                stream.expect(':')
+                if key == 'phrases' and stream.peek() == '[':
+                    break
+                stream.value()
+        elif first != '[':
+            raise ValueError(f'{path} is neither a list nor an object with a "phrases" list')
+        stream.pos += 1
+        while True:
+            char = stream.peek(SEPARATORS)
+            if char == ']':
+                return
+            if not char:
+                raise ValueError(f'{path} ends inside the phrase list')
+            value = stream.value()
+            if isinstance(value, str):
+                yield value
+
+
+def iter_csv_phrases(path):
+    with open(path, encoding='utf-8', newline='') as file:
+        for i, row in enumerate(csv.reader(file)):
+            if not row:
+                continue
+            if i == 0 and row[0].strip().lower() == 'phrase':
+                continue
+            yield row[0]
+
+
+def iter_phrases(path):
+    if path.endswith('.csv'):
+        return iter_csv_phrases(path)
+    return iter_json_phrases(path)
+
+
+def normalise(phrase):
+    return ' '.join(unicodedata.normalize('NFC', phrase).split())
+
+
+def iter_batches(paths, batch_size):
+    batch, seen = [], set()
+    for path in paths:
+        for phrase in iter_phrases(path):
+            phrase = normalise(phrase)
+            if not phrase or phrase in seen:
+                continue
+            seen.add(phrase)
+            batch.append(phrase)
+            if len(batch) >= batch_size:
+                yield batch
+                batch, seen = [], set()
+    if batch:
+        yield batch
+
+
+async def ensure_index(collection):
+    try:
+        await collection.create_index([('phrase', ASCENDING)], unique=True)
+    except OperationFailure as e:
+        logging.warning("Could not create unique phrase index on %s (%s), duplicates already stored stay", collection.name, e)
+
+
+async def import_phrases(db, target, paths, batch_size=1000, swap=False):
+    collection = db[f'{target}__import'] if swap else db[target]
+    if swap:
+        await collection.drop()
+    await ensure_index(collection)
+
+    started = time.perf_counter()
+    read = inserted = 0
+    for batch in iter_batches(paths, batch_size):
+        requests = [UpdateOne({'phrase': phrase}, {'$setOnInsert': {'phrase': phrase}}, upsert=True) for phrase in batch]
+        result = await collection.bulk_write(requests, ordered=False)
+        read += len(batch)
+        inserted += result.upserted_count
+
+    if swap:
+        if not read:
+            await collection.drop()
+            logging.warning("No phrases found in %s, leaving %s untouched", ', '.join(paths), target)
+            return read, inserted
+        await collection.rename(target, dropTarget=True)
+
+    elapsed = time.perf_counter() - started
+    logging.info(
+        "%s: %d phrases read, %d new, %.2fs (%.0f phrases/s)",
+        target, read, inserted, elapsed, read / elapsed if elapsed else 0,
+    )
+    return read, inserted
+
+
+async def main(args):
+    client = AsyncIOMotorClient(args.mongo_uri)
+    await import_phrases(client[args.database], args.collection, args.sources, args.batch_size, args.swap)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s | %(levelname)s | %(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Import phrases from JSON/CSV files into a phrase collection.")
+    parser.add_argument('collection', help="target collection, e.g. phrases_list_2")
+    parser.add_argument('sources', nargs='+', help="JSON (list or {\"phrases\": [...]}) or CSV files")
+    parser.add_argument('--swap', action='store_true', help="load into a staging collection and swap it in when done")
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--mongo-uri', default=MONGO_URI)
+    parser.add_argument('--database', default='telegram_bot')
+    asyncio.run(main(parser.parse_args()))
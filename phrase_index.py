@@ -0,0 +1,262 @@
+import copy
+import logging
+import os
+
+import numpy as np
+
+BUCKET_BITS = 18
+NGRAM = 3
+MULTIPLIERS = np.array([0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9], dtype=np.uint64)
+
+
+def ngrams(texts, bits=BUCKET_BITS):
+    """Hashed character trigrams of each text as (rows, grams, tf), one entry per distinct gram of a row."""
+    if not texts:
+        empty = np.zeros(0, np.int32)
+        return empty, empty, np.zeros(0, np.float32)
+    padded = [f" {' '.join(text.lower().split())} " for text in texts]
+    # One pass over all texts joined by NULs; grams spanning a separator are dropped.
+    codes = np.frombuffer('\0'.join(padded).encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    lengths = np.fromiter(map(len, padded), dtype=np.int64, count=len(padded))
+    owner = np.repeat(np.arange(len(padded), dtype=np.int64), lengths + 1)[:len(codes)]
+
+    windows = [codes[i:len(codes) - NGRAM + 1 + i] for i in range(NGRAM)]
+    valid = np.logical_and.reduce([window != 0 for window in windows])
+    hashes = sum(window * multiplier for window, multiplier in zip(windows, MULTIPLIERS))
+    grams = (hashes[valid] >> np.uint64(64 - bits)).astype(np.int64)
+
+    keys, counts = np.unique(owner[:len(valid)][valid] << bits | grams, return_counts=True)
+    rows = (keys >> bits).astype(np.int32)
+    grams = (keys & ((1 << bits) - 1)).astype(np.int32)
+    return rows, grams, (1 + np.log(counts)).astype(np.float32)
+
+
+class PhraseIndex:
+    """Character n-gram TF-IDF index over one phrase list, kept as inverted postings.
+
+    Rows added since the last merge live in a small pending segment and deleted rows are
+    only masked, so updates are cheap; merging folds both into the postings and refreshes
+    the row norms against the current document frequencies. add and remove never merge by
+    themselves: the owner checks wants_merge and merges a copy off the event loop.
+    """
+
+    CHUNK = 4096
+    MIN_DF_CUTOFF = 1000
+
+    def __init__(self, bits=BUCKET_BITS, max_df=0.25, merge_every=256):
+        self.bits = bits
+        self.buckets = 1 << bits
+        self.max_df = max_df
+        self.merge_every = merge_every
+        self.reset()
+
+    def reset(self):
+        self.keys = []
+        self.rows = {}
+        self.alive = bytearray()
+        self.norms = np.zeros(0, np.float32)
+        self.df = np.zeros(self.buckets, np.int32)
+        self.indptr = np.zeros(self.buckets + 1, np.int64)
+        self.posting_rows = np.zeros(0, np.int32)
+        self.posting_tf = np.zeros(0, np.float32)
+        self.merged = 0
+        self.pending_rows = np.zeros(0, np.int32)
+        self.pending_grams = np.zeros(0, np.int32)
+        self.pending_tf = np.zeros(0, np.float32)
+        self.dead = 0
+        self.dirty = True
+
+    def __len__(self):
+        return len(self.rows)
+
+    def copy(self):
+        # Merged arrays are only ever replaced, never written in place, so they can be shared.
+        other = copy.copy(self)
+        other.keys = list(self.keys)
+        other.rows = dict(self.rows)
+        other.alive = bytearray(self.alive)
+        other.df = self.df.copy()
+        return other
+
+    def wants_merge(self):
+        pending = len(self.keys) - self.merged
+        return pending >= max(self.merge_every, self.merged // 20) or self.dead > max(self.merge_every, len(self.keys) // 10)
+
+    def idf(self, grams=None):
+        df = self.df if grams is None else self.df[grams]
+        return (np.log((1 + len(self.rows)) / (1 + df)) + 1).astype(np.float32)
+
+    def build(self, items):
+        self.reset()
+        items = list(items)
+        self.append([key for key, _ in items], [text for _, text in items])
+        self.merge()
+
+    def add(self, key, text):
+        if key in self.rows:
+            self.remove(key)
+        self.append([key], [text])
+
+    def append(self, keys, texts):
+        # Chunked so a full build does not hold every text's intermediate arrays at once.
+        chunks = [ngrams(texts[i:i + self.CHUNK], self.bits) for i in range(0, len(texts), self.CHUNK)]
+        if chunks:
+            rows = np.concatenate([chunk_rows + i * self.CHUNK for i, (chunk_rows, _, _) in enumerate(chunks)])
+            grams = np.concatenate([grams for _, grams, _ in chunks])
+            tf = np.concatenate([tf for _, _, tf in chunks])
+        else:
+            rows, grams, tf = ngrams([], self.bits)
+        np.add.at(self.df, grams, 1)
+        first = len(self.keys)
+        for key in keys:
+            self.rows[key] = len(self.keys)
+            self.keys.append(key)
+        self.alive.extend(b'\1' * len(keys))
+        weights = tf * self.idf(grams)
+        norms = np.sqrt(np.bincount(rows, weights * weights, minlength=len(keys))).astype(np.float32)
+        self.norms = np.concatenate([self.norms, norms])
+        self.pending_rows = np.concatenate([self.pending_rows, rows + first])
+        self.pending_grams = np.concatenate([self.pending_grams, grams])
+        self.pending_tf = np.concatenate([self.pending_tf, tf])
+        self.dirty = True
+
+    def remove(self, key):
+        row = self.rows.pop(key, None)
+        if row is None:
+            return
+        self.alive[row] = 0
+        self.dead += 1
+        self.dirty = True
+        np.subtract.at(self.df, self.row_grams(row), 1)
+
+    def row_grams(self, row):
+        if row >= self.merged:
+            return self.pending_grams[self.pending_rows == row]
+        return np.searchsorted(self.indptr, np.flatnonzero(self.posting_rows == row), side='right') - 1
+
+    def gram_of_posting(self):
+        return np.repeat(np.arange(self.buckets, dtype=np.int32), np.diff(self.indptr))
+
+    def merge(self):
+        grams = np.concatenate([self.gram_of_posting(), self.pending_grams])
+        rows = np.concatenate([self.posting_rows, self.pending_rows])
+        tf = np.concatenate([self.posting_tf, self.pending_tf])
+
+        alive = np.frombuffer(bytes(self.alive), dtype=np.bool_)
+        keep = alive[rows]
+        grams, rows, tf = grams[keep], rows[keep], tf[keep]
+        rows = (np.cumsum(alive, dtype=np.int32) - 1)[rows]
+        self.keys = [key for key, live in zip(self.keys, alive) if live]
+        self.rows = {key: row for row, key in enumerate(self.keys)}
+        self.alive = bytearray(b'\1' * len(self.keys))
+        self.dead = 0
+
+        weights = tf * self.idf()[grams]
+        self.norms = np.sqrt(np.bincount(rows, weights * weights, minlength=len(self.keys))).astype(np.float32)
+        del weights
+        order = np.argsort(grams, kind='stable')
+        self.posting_rows, self.posting_tf = rows[order], tf[order]
+        self.indptr = np.concatenate([[0], np.cumsum(np.bincount(grams, minlength=self.buckets))])
+        self.merged = len(self.keys)
+        self.pending_rows = np.zeros(0, np.int32)
+        self.pending_grams = np.zeros(0, np.int32)
+        self.pending_tf = np.zeros(0, np.float32)
+
+    def query(self, text, k=20):
+        """Rows of the k best matching phrases, as (keys, cosine scores), best first."""
+        if not self.rows:
+            return [], np.zeros(0, np.float32)
+        _, grams, tf = ngrams([text], self.bits)
+        df = self.df[grams]
+        # Grams shared by a large part of the list say little and cost the most to score.
+        useful = (df > 0) & (df <= max(self.MIN_DF_CUTOFF, self.max_df * len(self.rows)))
+        grams, tf = grams[useful], tf[useful]
+        if not len(grams):
+            return [], np.zeros(0, np.float32)
+        weights = tf * self.idf(grams)
+        weights /= np.sqrt(np.dot(weights, weights))
+        weights *= self.idf(grams)
+
+        starts, ends = self.indptr[grams], self.indptr[grams + 1]
+        lengths = ends - starts
+        positions = np.repeat(ends - np.cumsum(lengths), lengths) + np.arange(lengths.sum())
+        scores = np.bincount(
+            self.posting_rows[positions],
+            self.posting_tf[positions] * np.repeat(weights, lengths),
+            minlength=len(self.keys),
+        ).astype(np.float32)
+        if len(self.pending_rows):
+            # Query grams come out of ngrams() sorted, so the pending entries can be matched by bisection.
+            found = np.clip(np.searchsorted(grams, self.pending_grams), 0, len(grams) - 1)
+            match = grams[found] == self.pending_grams
+            scores += np.bincount(
+                self.pending_rows[match], self.pending_tf[match] * weights[found[match]], minlength=len(self.keys)
+            )
+
+        scores[self.norms > 0] /= self.norms[self.norms > 0]
+        scores *= np.frombuffer(bytes(self.alive), dtype=np.bool_)
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[scores[top] > 0]
+        top = top[np.argsort(-scores[top])]
+        return [self.keys[row] for row in top], scores[top]
+
+    def sync(self, ids, texts):
+        """Brings a freshly loaded (or just restored) index in line with the phrase list."""
+        by_str = {str(doc_id): doc_id for doc_id in ids}
+        # Keys restored from disk are strings; map them back to the real ids.
+        self.keys = [by_str.get(str(key), key) for key in self.keys]
+        self.rows = {self.keys[row]: row for row in self.rows.values()}
+        wanted = dict(zip(ids, texts))
+        stale = [key for key in self.rows if key not in wanted]
+        fresh = [(doc_id, text) for doc_id, text in wanted.items() if doc_id not in self.rows]
+        if len(stale) + len(fresh) > len(wanted) // 2:
+            self.build(wanted.items())
+            return
+        for key in stale:
+            self.remove(key)
+        if fresh:
+            self.append([doc_id for doc_id, _ in fresh], [text for _, text in fresh])
+        if stale or fresh:
+            self.merge()
+
+    def save(self, path):
+        self.merge()
+        tmp = f'{path}.tmp'
+        with open(tmp, 'wb') as file:
+            np.savez(
+                file,
+                bits=self.bits,
+                keys=np.array([str(key) for key in self.keys], dtype=str),
+                df=self.df,
+                norms=self.norms,
+                indptr=self.indptr,
+                posting_rows=self.posting_rows,
+                posting_tf=self.posting_tf,
+            )
+        os.replace(tmp, path)
+        self.dirty = False
+
+    def load(self, path):
+        if not os.path.exists(path):
+            return False
+        try:
+            with np.load(path) as data:
+                if int(data['bits']) != self.bits:
+                    return False
+                self.reset()
+                self.keys = data['keys'].tolist()
+                self.df = data['df']
+                self.norms = data['norms']
+                self.indptr = data['indptr']
+                self.posting_rows = data['posting_rows']
+                self.posting_tf = data['posting_tf']
+        except (OSError, KeyError, ValueError) as e:
+            logging.warning("Could not load phrase index %s (%s), rebuilding", path, e)
+            self.reset()
+            return False
+        self.rows = {key: row for row, key in enumerate(self.keys)}
+        self.alive = bytearray(b'\1' * len(self.keys))
+        self.merged = len(self.keys)
+        self.dirty = False
+        return True
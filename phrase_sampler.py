@@ -0,0 +1,104 @@
+import random
+from collections import OrderedDict, deque
+
+
+class RecentWindow:
+    __slots__ = ('order', 'members')
+
+    def __init__(self, ids=()):
+        self.order = deque(ids)
+        self.members = set(self.order)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.members
+
+    def __len__(self):
+        return len(self.order)
+
+    def push(self, doc_id, limit):
+        self.order.append(doc_id)
+        self.members.add(doc_id)
+        self.trim(limit)
+
+    def trim(self, limit):
+        while len(self.order) > limit:
+            self.members.discard(self.order.popleft())
+
+
+class NoRepeatSampler:
+    ATTEMPTS = 4
+
+    def __init__(self, cache, window=20, max_histories=10000):
+        self.cache = cache
+        self.window = window
+        self.max_histories = max_histories
+        self.histories = OrderedDict()
+
+    def history(self, chat_id, list_name):
+        key = (chat_id, list_name)
+        window = self.histories.get(key)
+        if window is None:
+            window = self.histories[key] = RecentWindow()
+            if len(self.histories) > self.max_histories:
+                self.histories.popitem(last=False)
+        else:
+            self.histories.move_to_end(key)
+        return window
+
+    def pick(self, chat_id, list_name):
+        ids, phrases = self.cache.ids[list_name], self.cache.phrases[list_name]
+        size = len(ids)
+        if not size:
+            return None
+
+        limit = min(self.window, size - 1)
+        recent = self.history(chat_id, list_name)
+        recent.trim(limit)
+
+        index = random.randrange(size)
+        for _ in range(self.ATTEMPTS):
+            if ids[index] not in recent:
+                break
+            index = random.randrange(size)
+        else:
+            # At most `limit` ids are recent, so limit + 1 consecutive slots always hold a fresh one.
+            for _ in range(limit + 1):
+                if ids[index] not in recent:
+                    break
+                index = (index + 1) % size
+
+        recent.push(ids[index], limit)
+        return phrases[index]
+
+    def pick_ranked(self, chat_id, list_name, ranked):
+        # Ranked cache positions, best first; if all of them were sent recently, any fresh phrase will do.
+        ids = self.cache.ids[list_name]
+        recent = self.history(chat_id, list_name)
+        for index in ranked:
+            if ids[index] not in recent:
+                recent.push(ids[index], min(self.window, len(ids) - 1))
+                return self.cache.phrases[list_name][index]
+        return self.pick(chat_id, list_name)
+
+    def pick_from(self, chat_id, list_name, candidates):
+        # Candidates come from a server-side $sample of a list too big to cache.
+        if not candidates:
+            return None
+        recent = self.history(chat_id, list_name)
+        doc_id, phrase = next((candidate for candidate in candidates if candidate[0] not in recent), candidates[0])
+        recent.push(doc_id, self.window)
+        return phrase
+
+    def recent_ids(self, chat_id, list_names):
+        recent = {}
+        for list_name in list_names:
+            window = self.histories.get((chat_id, list_name))
+            if window:
+                recent[list_name] = list(window.order)
+        return recent
+
+    def restore(self, chat_id, recent):
+        for list_name, ids in recent.items():
+            self.histories[(chat_id, list_name)] = RecentWindow(ids[-self.window:])
+        while len(self.histories) > self.max_histories:
+            self.histories.popitem(last=False)
@@ -0,0 +1,166 @@
+import asyncio
+import logging
+import math
+import os
+import random
+
+from pymongo.errors import DuplicateKeyError
+
+from phrase_cache import PhraseCache
+from phrase_importer import ensure_index, normalise
+from phrase_index import PhraseIndex
+from phrase_sampler import NoRepeatSampler
+
+DEFAULT_LISTS = [
+    {'_id': 'хуйня', 'collection': 'phrases_list_1', 'label': 'Хуйня'},
+    {'_id': 'цитаты', 'collection': 'phrases_list_2', 'label': 'Цитаты'},
+]
+
+
+def usable_weight(weight):
+    if not isinstance(weight, (int, float)) or not math.isfinite(weight) or weight < 0:
+        return 0
+    return weight
+
+
+class PhraseStore:
+    def __init__(self, db, window=20, max_histories=10000, cache_limit=200000, sample_size=8, index_dir=None, top_k=20):
+        self.db = db
+        self.registry = db['phrase_lists']
+        self.cache_limit = cache_limit
+        self.sample_size = sample_size
+        self.index_dir = index_dir
+        self.top_k = top_k
+        self.collections = {}
+        self.labels = {}
+        self.sizes = {}
+        self.cache = PhraseCache(db)
+        self.sampler = NoRepeatSampler(self.cache, window, max_histories)
+
+    def names(self):
+        return list(self.collections)
+
+    def __contains__(self, list_name):
+        return list_name in self.collections
+
+    def size(self, list_name):
+        if list_name in self.cache:
+            return self.cache.size(list_name)
+        return self.sizes.get(list_name, 0)
+
+    async def load(self):
+        docs = await self.registry.find({}).to_list(length=None)
+        if not docs:
+            for doc in DEFAULT_LISTS:
+                await self.registry.update_one({'_id': doc['_id']}, {'$setOnInsert': doc}, upsert=True)
+            docs = DEFAULT_LISTS
+        for doc in docs:
+            self.collections[doc['_id']] = self.db[doc['collection']]
+            self.labels[doc['_id']] = doc.get('label', doc['_id'])
+        await asyncio.gather(*(self.prepare(list_name) for list_name in self.collections))
+
+    async def prepare(self, list_name):
+        collection = self.collections[list_name]
+        await ensure_index(collection)
+        count = await collection.estimated_document_count()
+        if count > self.cache_limit:
+            self.sizes[list_name] = count
+            logging.info("'%s' has %d phrases, sampling it server-side", list_name, count)
+            return
+        self.cache.register(list_name, collection)
+        if self.index_dir:
+            index = self.cache.indexes[list_name] = PhraseIndex()
+            if index.load(self.index_path(list_name)):
+                logging.info("Loaded phrase index for '%s' with %d phrases", list_name, len(index))
+        await self.cache.load(list_name)
+        if self.index_dir and self.cache.indexes[list_name].dirty:
+            await self.save_index(list_name)
+
+    def index_path(self, list_name):
+        return os.path.join(self.index_dir, f'{self.collections[list_name].name}.npz')
+
+    async def save_index(self, list_name):
+        os.makedirs(self.index_dir, exist_ok=True)
+        index = self.cache.indexes[list_name]
+        # Saving merges first, so it works on a copy in a thread and queries go on meanwhile.
+        await asyncio.to_thread(index.copy().save, self.index_path(list_name))
+        index.dirty = False
+
+    def pick_list(self, weights=None):
+        names = self.names()
+        sizes = [self.size(name) for name in names]
+        if weights:
+            # Empty lists never win, whatever their weight; weights stored before they were
+            # validated may be negative or non-finite, and those count as zero.
+            weighted = [usable_weight(weights.get(name, 0)) if size else 0 for name, size in zip(names, sizes)]
+            if sum(weighted) > 0:
+                sizes = weighted
+        if sum(sizes) <= 0:
+            return None
+        return random.choices(names, weights=sizes)[0]
+
+    async def pick(self, chat_id, list_name=None, weights=None):
+        list_name = list_name or self.pick_list(weights)
+        if list_name not in self.collections:
+            return None
+        if list_name in self.cache:
+            if not self.cache.size(list_name):
+                return None
+            return self.sampler.pick(chat_id, list_name)
+
+        docs = await self.collections[list_name].aggregate([
+            {'$sample': {'size': self.sample_size}},
+            {'$project': {'phrase': 1}},
+        ]).to_list(length=None)
+        return self.sampler.pick_from(chat_id, list_name, [(doc['_id'], doc['phrase']) for doc in docs])
+
+    async def pick_reply(self, chat_id, list_name, text):
+        index = self.cache.indexes.get(list_name)
+        if index is None or not text:
+            return await self.pick(chat_id, list_name)
+        keys, scores = index.query(text, self.top_k)
+        positions = self.cache.positions[list_name]
+        # Weighted random order over the top-k, so better matches come up more often but not always.
+        order = sorted(range(len(keys)), key=lambda i: random.random() ** (1 / scores[i]), reverse=True)
+        ranked = [positions[keys[i]] for i in order if keys[i] in positions]
+        if not ranked:
+            return await self.pick(chat_id, list_name)
+        return self.sampler.pick_ranked(chat_id, list_name, ranked)
+
+    async def add(self, list_name, phrase):
+        phrase = normalise(phrase)
+        try:
+            result = await self.collections[list_name].insert_one({'phrase': phrase})
+        except DuplicateKeyError:
+            return False
+        if list_name in self.cache:
+            self.cache.add(list_name, result.inserted_id, phrase)
+        else:
+            self.sizes[list_name] += 1
+        return True
+
+    async def delete_recent(self, list_name):
+        # Served by the _id index: ObjectIds grow with insertion time.
+        doc = await self.collections[list_name].find_one_and_delete({}, {'phrase': 1}, sort=[('_id', -1)])
+        if not doc:
+            return None
+        if list_name in self.cache:
+            self.cache.remove(list_name, doc['_id'])
+        else:
+            self.sizes[list_name] -= 1
+        return doc['phrase']
+
+    def recent_ids(self, chat_id):
+        return self.sampler.recent_ids(chat_id, self.collections)
+
+    def restore(self, chat_id, recent):
+        self.sampler.restore(chat_id, {name: ids for name, ids in recent.items() if name in self.collections})
+
+    def start_watching(self):
+        self.cache.start_watching()
+
+    async def stop_watching(self):
+        await self.cache.stop_watching()
+        for list_name, index in self.cache.indexes.items():
+            if index.dirty:
+                await self.save_index(list_name)
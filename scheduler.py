@@ -0,0 +1,110 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+
+
+class ChatScheduler:
+    FIRING = object()
+
+    def __init__(self, callback, interval_for):
+        self.callback = callback
+        self.interval_for = interval_for
+        self.heap = []
+        self.entries = {}
+        self.counter = itertools.count(1)
+        self.wakeup = asyncio.Event()
+        self.loop_task = None
+        self.fire_tasks = set()
+
+    def __contains__(self, chat_id):
+        return chat_id in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def chats(self):
+        return list(self.entries)
+
+    def start(self, chat_id):
+        if chat_id in self.entries:
+            return False
+        self.push(chat_id)
+        return True
+
+    def stop(self, chat_id):
+        return self.entries.pop(chat_id, None) is not None
+
+    def reschedule(self, chat_id):
+        if self.entries.get(chat_id, self.FIRING) is not self.FIRING:
+            self.push(chat_id)
+
+    def status(self, chat_id):
+        entry = self.entries.get(chat_id)
+        if entry is None:
+            return None
+        if entry is self.FIRING:
+            return 0.0
+        return max(0.0, entry[0] - asyncio.get_running_loop().time())
+
+    def push(self, chat_id):
+        min_interval, max_interval = self.interval_for(chat_id)
+        delay = random.randint(min_interval, max_interval)
+        entry = (asyncio.get_running_loop().time() + delay, next(self.counter), chat_id)
+        self.entries[chat_id] = entry
+        heapq.heappush(self.heap, entry)
+        logging.info("Sending message in %d seconds to chat %s...", delay, chat_id)
+        # Stale heap entries are skipped lazily; compact once they dominate.
+        if len(self.heap) > 2 * len(self.entries) + 64:
+            self.heap = [entry for entry in self.heap if self.entries.get(entry[2]) is entry]
+            heapq.heapify(self.heap)
+        self.wakeup.set()
+
+    def start_loop(self):
+        if not self.loop_task:
+            self.loop_task = asyncio.create_task(self.run())
+
+    async def shutdown(self):
+        tasks = [task for task in [self.loop_task, *self.fire_tasks] if task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.loop_task = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self.wakeup.clear()
+            timeout = None
+            while self.heap:
+                entry = self.heap[0]
+                fire_at, _, chat_id = entry
+                if self.entries.get(chat_id) is not entry:
+                    heapq.heappop(self.heap)
+                    continue
+                timeout = fire_at - loop.time()
+                if timeout > 0:
+                    break
+                heapq.heappop(self.heap)
+                timeout = None
+                self.fire(chat_id)
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def fire(self, chat_id):
+        self.entries[chat_id] = self.FIRING
+        task = asyncio.create_task(self.callback(chat_id))
+        self.fire_tasks.add(task)
+        task.add_done_callback(lambda task: self.fired(chat_id, task))
+
+    def fired(self, chat_id, task):
+        self.fire_tasks.discard(task)
+        if task.cancelled():
+            return
+        if task.exception():
+            logging.error("Scheduled send failed in chat %s", chat_id, exc_info=task.exception())
+        if self.entries.get(chat_id) is self.FIRING:
+            self.push(chat_id)
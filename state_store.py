@@ -0,0 +1,55 @@
+import asyncio
+import logging
+
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+
+
+class ChatStateStore:
+    def __init__(self, collection, snapshot, flush_interval=5):
+        self.collection = collection
+        self.snapshot = snapshot
+        self.flush_interval = flush_interval
+        self.dirty = set()
+        self.flush_task = None
+
+    def mark(self, chat_id):
+        self.dirty.add(chat_id)
+
+    async def load(self):
+        return await self.collection.find({}).to_list(length=None)
+
+    async def flush(self):
+        if not self.dirty:
+            return 0
+        dirty, self.dirty = self.dirty, set()
+        snapshots = ((chat_id, self.snapshot(chat_id)) for chat_id in dirty)
+        requests = [UpdateOne({'_id': chat_id}, {'$set': snapshot}, upsert=True) for chat_id, snapshot in snapshots if snapshot]
+        if not requests:
+            return 0
+        try:
+            await self.collection.bulk_write(requests, ordered=False)
+        except PyMongoError as e:
+            logging.error("Failed to flush state for %d chats: %s", len(dirty), e)
+            self.dirty |= dirty
+            return 0
+        return len(requests)
+
+    def start_flushing(self):
+        if not self.flush_task:
+            self.flush_task = asyncio.create_task(self.flush_periodically())
+
+    async def stop_flushing(self):
+        if self.flush_task:
+            self.flush_task.cancel()
+            try:
+                await self.flush_task
+            except asyncio.CancelledError:
+                pass
+            self.flush_task = None
+        await self.flush()
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
@@ -0,0 +1,106 @@
+import asyncio
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+
+from outbound import REPLY, OutboundDispatcher
+
+
+def run(scenario):
+    async def main():
+        dispatcher = OutboundDispatcher(global_rate=1000, chat_rate=20, group_rate=20, group_burst=1)
+        dispatcher.start()
+        try:
+            return await scenario(dispatcher)
+        finally:
+            await dispatcher.shutdown()
+    return asyncio.run(main())
+
+
+def recorder(log):
+    def call(tag, failures=0):
+        attempts = [0]
+
+        async def send():
+            if attempts[0] < failures:
+                attempts[0] += 1
+                raise RetryAfter(timedelta(seconds=0.05))
+            log.append(tag)
+            return tag
+        return send
+    return call
+
+
+def test_reply_overtakes_deferred_chatter():
+    log = []
+    call = recorder(log)
+
+    async def scenario(dispatcher):
+        scheduled = [dispatcher.submit(-1, call(f'scheduled{i}')) for i in range(4)]
+        await asyncio.sleep(0.01)
+        reply = dispatcher.submit(-1, call('reply'), priority=REPLY)
+        await asyncio.gather(reply, *scheduled)
+
+    run(scenario)
+    assert log == ['scheduled0', 'reply', 'scheduled1', 'scheduled2', 'scheduled3']
+
+
+def test_retry_after_retries_the_send():
+    log = []
+    call = recorder(log)
+
+    async def scenario(dispatcher):
+        return await dispatcher.submit(5, call('retried', failures=1)), dispatcher.counters
+
+    result, counters = run(scenario)
+    assert result == 'retried'
+    assert log == ['retried']
+    assert counters['retried'] == 1 and counters['sent'] == 1
+
+
+def test_retry_after_gives_up():
+    log = []
+    call = recorder(log)
+
+    async def scenario(dispatcher):
+        return await dispatcher.submit(5, call('never', failures=OutboundDispatcher.MAX_ATTEMPTS)), dispatcher.counters
+
+    result, counters = run(scenario)
+    assert result is None and log == []
+    assert counters['dropped'] == 1
+
+
+def test_flood_in_several_chats_pauses_everything():
+    log = []
+    call = recorder(log)
+
+    async def scenario(dispatcher):
+        loop = asyncio.get_running_loop()
+        flooded = [dispatcher.submit(chat_id, call(chat_id, failures=1)) for chat_id in range(1, 1 + dispatcher.FLOOD_CHATS)]
+        await asyncio.sleep(0.01)
+        started = loop.time()
+        await dispatcher.submit(100, call('other'))
+        waited = loop.time() - started
+        await asyncio.gather(*flooded)
+        return waited
+
+    assert run(scenario) >= 0.03
+    assert 'other' in log
+
+
+def test_flood_in_one_chat_does_not_pause_others():
+    log = []
+    call = recorder(log)
+
+    async def scenario(dispatcher):
+        loop = asyncio.get_running_loop()
+        flooded = dispatcher.submit(1, call('flooded', failures=1))
+        await asyncio.sleep(0.01)
+        started = loop.time()
+        await dispatcher.submit(100, call('other'))
+        waited = loop.time() - started
+        await flooded
+        return waited
+
+    assert run(scenario) < 0.03
+    assert log == ['other', 'flooded']
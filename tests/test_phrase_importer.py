@@ -0,0 +1,51 @@
+import json
+
+import pytest
+
+import phrase_importer
+from phrase_importer import iter_json_phrases
+
+
+def write(tmp_path, text, name='phrases.json'):
+    path = tmp_path / name
+    path.write_text(text, encoding='utf-8')
+    return str(path)
+
+
+def test_bare_list(tmp_path):
+    path = write(tmp_path, json.dumps(['один', 'два "в кавычках"', 3, 'три'], ensure_ascii=False))
+    assert list(iter_json_phrases(path)) == ['один', 'два "в кавычках"', 'три']
+
+
+def test_object_with_phrases(tmp_path):
+    path = write(tmp_path, json.dumps({'meta': {'tags': ['t1']}, 'count': 2, 'phrases': ['x', 'y']}))
+    assert list(iter_json_phrases(path)) == ['x', 'y']
+
+
+def test_bracket_inside_string(tmp_path):
+    path = write(tmp_path, json.dumps({'title': 'a [b]', 'phrases': ['[x]', 'y]']}))
+    assert list(iter_json_phrases(path)) == ['[x]', 'y]']
+
+
+def test_empty_file(tmp_path):
+    assert list(iter_json_phrases(write(tmp_path, ''))) == []
+    assert list(iter_json_phrases(write(tmp_path, ' \n'))) == []
+
+
+def test_object_without_phrases(tmp_path):
+    path = write(tmp_path, json.dumps({'meta': {'tags': ['t1']}}))
+    with pytest.raises(ValueError):
+        list(iter_json_phrases(path))
+
+
+def test_truncated_list(tmp_path):
+    path = write(tmp_path, '["x", "y"')
+    with pytest.raises(ValueError):
+        list(iter_json_phrases(path))
+
+
+def test_values_across_reads(tmp_path, monkeypatch):
+    monkeypatch.setattr(phrase_importer, 'READ_SIZE', 7)
+    phrases = [f'фраза номер {i}' for i in range(200)]
+    path = write(tmp_path, json.dumps({'skip': {'nested': list(range(50))}, 'phrases': phrases}, ensure_ascii=False))
+    assert list(iter_json_phrases(path)) == phrases
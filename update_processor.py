@@ -0,0 +1,41 @@
+import asyncio
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    # The base class takes its semaphore before do_process_update, so updates queued on a busy
+    # chat's lock would hold every slot; the real limit is taken only once the lock is ours.
+    UNBOUNDED = 2**31 - 1
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(self.UNBOUNDED)
+        self.slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self.chat_locks = {}
+
+    async def do_process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if not chat:
+            async with self.slots:
+                await coroutine
+            return
+
+        entry = self.chat_locks.get(chat.id)
+        if entry is None:
+            entry = self.chat_locks[chat.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            # asyncio.Lock wakes waiters in FIFO order, so updates of one chat run in arrival order.
+            async with entry[0], self.slots:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.chat_locks[chat.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
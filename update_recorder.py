@@ -0,0 +1,69 @@
+import asyncio
+import gzip
+import json
+import logging
+import time
+
+
+def read_recording(path):
+    """Yields the records of a recording: a {'bot': ...} header per session, then {'t': ..., 'u': ...} updates."""
+    with gzip.open(path, 'rt', encoding='utf-8') as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+class UpdateRecorder:
+    FLUSH_INTERVAL = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.buffer = []
+        self.count = 0
+        self.flush_task = None
+
+    async def record(self, update, context):
+        # Runs in handler group -1 before everything else; only serialises, the disk write is batched.
+        self.buffer.append(json.dumps({'t': round(time.time(), 3), 'u': update.to_dict()}, ensure_ascii=False, separators=(',', ':')))
+        self.count += 1
+
+    def start(self, bot):
+        if self.flush_task:
+            return
+        # Appending a new gzip member per session keeps the file a single valid stream.
+        self.file = gzip.open(self.path, 'at', encoding='utf-8')
+        self.buffer.append(json.dumps({'bot': {'id': bot.id, 'username': bot.username}}, separators=(',', ':')))
+        self.flush_task = asyncio.create_task(self.flush_periodically())
+        logging.info("Recording updates to %s", self.path)
+
+    async def stop(self):
+        if not self.flush_task:
+            return
+        self.flush_task.cancel()
+        try:
+            await self.flush_task
+        except asyncio.CancelledError:
+            pass
+        self.flush_task = None
+        await self.flush()
+        await asyncio.to_thread(self.file.close)
+        logging.info("Recorded %d updates to %s", self.count, self.path)
+
+    async def flush(self):
+        if not self.buffer:
+            return
+        lines, self.buffer = self.buffer, []
+        await asyncio.to_thread(self.write, lines)
+
+    def write(self, lines):
+        self.file.write('\n'.join(lines) + '\n')
+        self.file.flush()
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except OSError as e:
+                logging.error("Failed to write recorded updates: %s", e)